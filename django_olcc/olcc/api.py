@@ -1,12 +1,69 @@
-from tastypie import fields
+from django.conf.urls.defaults import url
+from django.utils.cache import patch_vary_headers
+from tastypie import fields, http
+from tastypie.exceptions import BadRequest
 from tastypie.resources import ModelResource, ALL
-from olcc.models import Product, ProductPrice, Store
+from tastypie.throttle import CacheThrottle
+from tastypie.utils import trailing_slash
+from olcc.caching import cache_page, conditional
+from olcc.history import parse_history, percent_change, price_history, \
+        yearly_summary
+from olcc.models import PriceMover, Product, ProductPrice, Store
+from olcc.pagination import CachedCountPaginator, KeysetApiPaginator
+from olcc.spatial import nearest_stores, parse_location
 
-class ProductResource(ModelResource):
+# The number of uncached requests a client may make per hour
+THROTTLE_AT = 1000
+
+class ConditionalMixin(object):
+    """
+    Answer conditional GET requests for resources derived from the
+    latest import before doing any other work, and cache the serialized
+    responses until the next import.
+    """
+    def dispatch(self, request_type, request, **kwargs):
+        parent = super(ConditionalMixin, self)
+
+        @conditional
+        @cache_page
+        def view(request):
+            response = parent.dispatch(request_type, request, **kwargs)
+
+            # The response format may be chosen by the Accept header
+            patch_vary_headers(response, ('Accept',))
+            return response
+
+        return view(request)
+
+def embed_prices(bundles):
+    """
+    Add the price history of each product bundle to its data, loading
+    the prices for every bundle with a single query.
+    """
+    prices = dict((bundle.obj.pk, []) for bundle in bundles)
+
+    for product_id, amount, effective_date in ProductPrice.objects.filter(
+            product__in=prices.keys()).values_list('product', 'amount',
+                'effective_date'):
+        prices[product_id].append({
+            'amount': amount,
+            'effective_date': effective_date,
+        })
+
+    for bundle in bundles:
+        bundle.data['prices'] = prices[bundle.obj.pk]
+
+def to_float(values):
+    return [float(v) for v in values]
+
+class ProductResource(ConditionalMixin, ModelResource):
     class Meta:
         queryset = Product.objects.all()
         resource_name = 'product'
         allowed_methods = ['get']
+        history_allowed_methods = ['get']
+        paginator_class = KeysetApiPaginator
+        throttle = CacheThrottle(throttle_at=THROTTLE_AT)
         filtering = {
             'title': ALL,
             'code': ALL,
@@ -16,19 +73,152 @@ class ProductResource(ModelResource):
             'on_sale': ALL,
         }
 
-class ProductPriceResource(ModelResource):
+    def alter_list_data_to_serialize(self, request, data):
+        # Embed the price history of each product with ?prices=1
+        if request.GET.get('prices'):
+            embed_prices(data['objects'])
+        return data
+
+    def alter_detail_data_to_serialize(self, request, bundle):
+        if request.GET.get('prices'):
+            embed_prices([bundle])
+        return bundle
+
+    def override_urls(self):
+        return [
+            url(r'^(?P<resource_name>%s)/history%s$' % (
+                self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_history'),
+                name='api_product_history'),
+            url(r'^(?P<resource_name>%s)/(?P<pk>\d+)/history%s$' % (
+                self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_history'),
+                name='api_product_history'),
+        ]
+
+    def dispatch_history(self, request, **kwargs):
+        return self.dispatch('history', request, **kwargs)
+
+    def get_history(self, request, **kwargs):
+        """
+        Return the price history of one product, or of each product listed
+        in the `ids` parameter, as arrays of dates and amounts, oldest
+        first. The history may be limited with the `start` and `end`
+        parameters, and summarized by year with `aggregate=year`.
+        """
+        try:
+            ids, start, end, aggregate = parse_history(request.GET)
+        except ValueError, e:
+            raise BadRequest(str(e))
+
+        if 'pk' in kwargs:
+            ids = [int(kwargs['pk'])]
+        elif not ids:
+            raise BadRequest("Missing parameter: ids")
+
+        products = Product.objects.filter(pk__in=ids).only('id', 'code')
+        if not products and 'pk' in kwargs:
+            return http.HttpNotFound()
+
+        history = price_history([p.pk for p in products], start, end)
+
+        objects = []
+        for product in sorted(products, key=lambda p: ids.index(p.pk)):
+            dates, amounts = history[product.pk]['dates'], \
+                    history[product.pk]['amounts']
+
+            data = {
+                'id': product.pk,
+                'code': product.code,
+                'product': self.get_resource_uri(product),
+                'dates': dates,
+                'amounts': to_float(amounts),
+                'change': percent_change(amounts[0], amounts[-1]) if
+                    amounts else None,
+            }
+
+            if aggregate == 'year':
+                summary = yearly_summary(dates, amounts)
+                for key in ('min', 'max'):
+                    summary[key] = to_float(summary[key])
+                data['years'] = summary
+
+            objects.append(data)
+
+        if 'pk' in kwargs:
+            return self.create_response(request, objects[0])
+        return self.create_response(request, {'objects': objects})
+
+class ProductPriceResource(ConditionalMixin, ModelResource):
     product = fields.ToOneField(ProductResource, 'product')
 
     class Meta:
-        queryset = ProductPrice.objects.all()
+        # Load only the product id needed for its resource uri
+        queryset = ProductPrice.objects.select_related('product')\
+                .only('id', 'amount', 'effective_date', 'created_at',
+                        'modified_at', 'product__id')
         resource_name = 'price'
         allowed_methods = ['get']
+        paginator_class = CachedCountPaginator
+        throttle = CacheThrottle(throttle_at=THROTTLE_AT)
         filtering = {
             'product': ['exact'],
         }
 
-class StoreResource(ModelResource):
+class PriceMoverResource(ConditionalMixin, ModelResource):
+    product = fields.ToOneField(ProductResource, 'product')
+
+    class Meta:
+        # Load only the product id needed for its resource uri
+        queryset = PriceMover.objects.select_related('product')\
+                .only('id', 'month', 'previous_amount', 'amount', 'delta',
+                        'percent_delta', 'created_at', 'product__id')
+        resource_name = 'mover'
+        allowed_methods = ['get']
+        paginator_class = CachedCountPaginator
+        throttle = CacheThrottle(throttle_at=THROTTLE_AT)
+        filtering = {
+            'product': ['exact'],
+            'month': ['exact', 'gte', 'lte'],
+            'delta': ['lt', 'gt'],
+            'percent_delta': ['lt', 'gt'],
+        }
+        ordering = ['month', 'delta', 'percent_delta']
+
+class StoreResource(ConditionalMixin, ModelResource):
     class Meta:
         queryset = Store.objects.all()
         resource_name = 'store'
         allowed_methods = ['get']
+        near_allowed_methods = ['get']
+        paginator_class = CachedCountPaginator
+        throttle = CacheThrottle(throttle_at=THROTTLE_AT)
+
+    def override_urls(self):
+        return [
+            url(r'^(?P<resource_name>%s)/near%s$' % (
+                self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_near'), name='api_store_near'),
+        ]
+
+    def dispatch_near(self, request, **kwargs):
+        return self.dispatch('near', request, **kwargs)
+
+    def get_near(self, request, **kwargs):
+        """
+        Return the stores nearest the `lat` and `lng` parameters, nearest
+        first, with their distance in miles.
+        """
+        try:
+            lat, lng, k = parse_location(request.GET)
+        except ValueError, e:
+            raise BadRequest(str(e))
+
+        objects = []
+        for store in nearest_stores(lat, lng, k):
+            bundle = self.full_dehydrate(self.build_bundle(obj=store,
+                request=request))
+            bundle.data['distance'] = round(store.distance, 2)
+            objects.append(bundle)
+
+        return self.create_response(request, {'objects': objects})
@@ -0,0 +1,191 @@
+import datetime
+import hashlib
+import time
+
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.utils.cache import get_cache_key, learn_cache_key, \
+        patch_vary_headers
+from django.views.decorators.http import condition
+
+# How long to keep values in the shared cache
+CACHE_TIMEOUT = getattr(settings, 'OLCC_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+# How long each process may reuse a value without checking the shared cache
+LOCAL_CACHE_TIMEOUT = 60
+
+# The entries cached for each product: its page, its row in the product
+# lists and its API responses
+ENTRIES_PER_PRODUCT = 4
+
+LAST_UPDATED_KEY = 'olcc:last_updated'
+GENERATION_KEY = 'olcc:generation'
+
+# Values cached by this process, as (value, expires) tuples
+_local_cache = {}
+
+def last_updated():
+    """
+    Return the date of the latest ImportRecord, or None if nothing has
+    been imported yet.
+
+    The date is cached both in this process and in the shared cache, and
+    is invalidated whenever an ImportRecord is saved or deleted.
+    """
+    now = time.time()
+
+    value, expires = _local_cache.get(LAST_UPDATED_KEY, (None, 0))
+    if expires > now:
+        return value
+
+    value = cache.get(LAST_UPDATED_KEY)
+    if value is None:
+        from olcc.models import ImportRecord
+
+        try:
+            value = ImportRecord.objects.latest().created_at
+        except ImportRecord.DoesNotExist:
+            # Cache the absence of an import too
+            value = False
+
+        cache.set(LAST_UPDATED_KEY, value, CACHE_TIMEOUT)
+
+    value = value or None
+    _local_cache[LAST_UPDATED_KEY] = (value, now + LOCAL_CACHE_TIMEOUT)
+
+    return value
+
+def clear_last_updated(**kwargs):
+    """
+    Invalidate the cached date of the latest ImportRecord. This may be
+    connected as a signal receiver.
+    """
+    _local_cache.pop(LAST_UPDATED_KEY, None)
+    cache.delete(LAST_UPDATED_KEY)
+
+def generation():
+    """
+    Return the current cache generation. Cache keys for anything derived
+    from the imported data should include the generation, so that they
+    all expire at once when `bump_generation` is called.
+    """
+    value = cache.get(GENERATION_KEY)
+
+    if value is None:
+        cache.add(GENERATION_KEY, int(time.time()), CACHE_TIMEOUT)
+        value = cache.get(GENERATION_KEY)
+
+    return value
+
+def bump_generation():
+    """
+    Start a new cache generation. This should be called whenever an
+    import or a periodic update has finished.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time()), CACHE_TIMEOUT)
+
+    clear_last_updated()
+
+def check_cache_size(products, cache=cache):
+    """
+    Return a warning if the cache may be too small to hold the pages of
+    the given number of products until the next import, or None.
+
+    Backends which evict entries by memory rather than by count, such
+    as memcached, are not checked.
+    """
+    if isinstance(cache, BaseMemcachedCache):
+        return None
+
+    max_entries = cache._max_entries
+    needed = products * ENTRIES_PER_PRODUCT
+    if max_entries < needed:
+        return "The cache holds at most %s entries, but %s products need " \
+                "about %s. Raise the MAX_ENTRIES option of the cache." % (
+                    max_entries, products, needed)
+
+def cache_page(view):
+    """
+    Cache the responses of a view for the current cache generation.
+
+    Like Django's own `cache_page` the cache key is built from the request
+    URL and any headers the response varies on, but the key prefix
+    includes the cache generation.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, *args, **kwargs)
+
+        prefix = 'olcc.page.%s' % generation()
+
+        key = get_cache_key(request, prefix, cache=cache)
+        if key is not None:
+            response = cache.get(key)
+            if response is not None:
+                return response
+
+        response = view(request, *args, **kwargs)
+
+        if response.status_code == 200:
+            if request.META.get('CSRF_COOKIE_USED'):
+                # The response contains a CSRF token, which is only valid
+                # for a visitor that already has the matching cookie.
+                if settings.CSRF_COOKIE_NAME not in request.COOKIES:
+                    return response
+                patch_vary_headers(response, ('Cookie',))
+
+            key = learn_cache_key(request, response, CACHE_TIMEOUT, prefix,
+                    cache=cache)
+            cache.set(key, response, CACHE_TIMEOUT)
+
+        return response
+
+    return wrapper
+
+def site_last_modified(request, *args, **kwargs):
+    """
+    Return the date the site content last changed, which is the later of
+    the latest import and the start of the current month.
+
+    The dates are stored in local time, but `condition` formats and
+    compares the date as UTC, so it is converted first.
+    """
+    this_month = datetime.datetime.combine(
+            datetime.date.today().replace(day=1), datetime.time())
+
+    updated = last_updated()
+    if updated and updated > this_month:
+        this_month = updated
+
+    # Keep the microseconds, since the ETag is derived from this date too
+    return datetime.datetime.utcfromtimestamp(
+            time.mktime(this_month.timetuple())).replace(
+                    microsecond=this_month.microsecond)
+
+def site_etag(request, *args, **kwargs):
+    """
+    Return an ETag for a page derived from the latest import.
+
+    The cache generation is included, since periodic updates change the
+    data without a new import. The CSRF cookie and the Accept header are
+    included, since they change the rendered form tokens and the format
+    of API responses.
+    """
+    return hashlib.md5(':'.join([
+        site_last_modified(request).isoformat(),
+        str(generation()),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        request.META.get('HTTP_ACCEPT', ''),
+    ])).hexdigest()
+
+# Answer conditional requests for pages derived from the latest import
+# without calling the view.
+conditional = condition(etag_func=site_etag,
+        last_modified_func=site_last_modified)
@@ -1,12 +1,24 @@
-from olcc.models import ImportRecord
+from olcc.caching import CACHE_TIMEOUT, generation
+from olcc.caching import last_updated as get_last_updated
 
 """
 Inject the last import date into the request context.
 """
 def last_updated(request):
-    try:
+    value = get_last_updated()
+
+    if value:
         return {
-            'last_updated': ImportRecord.objects.latest().created_at
+            'last_updated': value
         }
-    except ImportRecord.DoesNotExist:
-        pass
+    return {}
+
+"""
+Inject the cache generation and timeout into the request context, for use
+with the '{% cache %}' template tag.
+"""
+def cache_generation(request):
+    return {
+        'cache_generation': generation(),
+        'cache_timeout': CACHE_TIMEOUT,
+    }
@@ -0,0 +1,120 @@
+import csv
+import uuid
+
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+
+from olcc.models import Product
+
+EXPORT_FIELDS = ('code', 'title', 'status', 'size', 'age', 'proof',
+        'bottles_per_case', 'on_sale', 'previous_price', 'current_price',
+        'next_price',)
+
+# The number of rows fetched from the database and written at a time
+CHUNK_SIZE = 1000
+
+# How long clients and proxies may reuse an export without revalidating
+EXPORT_MAX_AGE = 60 * 60
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+def iter_rows(queryset, fields, chunk_size=CHUNK_SIZE):
+    """
+    Yield the values of the given fields for every row in the queryset
+    without holding the results in memory.
+
+    On PostgreSQL the rows are read through a named, server-side cursor,
+    since psycopg2 otherwise fetches every row as soon as a query runs.
+    """
+    queryset = queryset.values_list(*fields)
+
+    if connection.vendor != 'postgresql':
+        for row in queryset.iterator():
+            yield row
+        return
+
+    sql, params = queryset.query.sql_with_params()
+
+    # Make sure we have a connection before asking for a named cursor
+    connection.cursor()
+    cursor = connection.connection.cursor(name='olcc_%s' % uuid.uuid4().hex)
+    cursor.itersize = chunk_size
+
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+def to_python(rows, model, fields):
+    """
+    Convert each row of raw database values to the Python types of the
+    given model fields, since some databases have no decimal type.
+    """
+    converters = [model._meta.get_field(f).to_python for f in fields]
+
+    for row in rows:
+        yield [convert(v) for convert, v in zip(converters, row)]
+
+def chunked(lines, chunk_size=CHUNK_SIZE):
+    """
+    Join the given lines into larger strings to write fewer chunks.
+    """
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+    if buf:
+        yield ''.join(buf)
+
+class Line(object):
+    """
+    A file-like object which returns whatever is written to it, so that
+    a csv.writer can format a single row at a time.
+    """
+    def write(self, value):
+        return value
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if value is None:
+        return ''
+    return value
+
+def export_csv(rows, fields=EXPORT_FIELDS):
+    """
+    Yield a header line and a line of CSV for each row.
+    """
+    writer = csv.writer(Line())
+
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([encode(v) for v in row])
+
+def export_ndjson(rows, fields=EXPORT_FIELDS):
+    """
+    Yield a line containing a JSON object for each row.
+    """
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+    for row in rows:
+        yield encoder.encode(OrderedDict(zip(fields, row))) + '\n'
+
+def export_products(format):
+    """
+    Return an iterator of the whole product catalog with prices,
+    formatted as CSV or newline delimited JSON.
+    """
+    exporter = {'csv': export_csv, 'ndjson': export_ndjson}[format]
+    rows = to_python(iter_rows(Product.objects.order_by('code'),
+        EXPORT_FIELDS), Product, EXPORT_FIELDS)
+    return chunked(exporter(rows))
@@ -0,0 +1,126 @@
+import logging
+import re
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from olcc.models import GeocodedAddress
+
+logger = logging.getLogger(__name__)
+
+# The default number of geocoder requests made per second
+GEOCODER_QPS = 2.5
+
+# The default number of concurrent geocoder requests
+GEOCODER_WORKERS = 4
+
+def normalize_address(address):
+    """
+    Normalize an address for use as a cache key.
+    """
+    address = re.sub(r'[^\w\s]', ' ', address.lower(), flags=re.UNICODE)
+    return ' '.join(address.split())[:200]
+
+class GoogleGeocoder(object):
+    """
+    A geocoder using the Google geocoding API.
+
+    Geocoders must implement a single `geocode` method which takes an
+    address and returns a tuple containing the formatted address and a
+    (latitude, longitude) tuple, or raises a ValueError if the address
+    could not be geocoded.
+    """
+    def __init__(self):
+        from geopy import geocoders
+        self.geocoder = geocoders.Google()
+
+    def geocode(self, address):
+        return self.geocoder.geocode(address)
+
+def get_geocoder():
+    """
+    Return an instance of the geocoder class named by the
+    OLCC_GEOCODER setting.
+    """
+    path = getattr(settings, 'OLCC_GEOCODER', 'olcc.geocoding.GoogleGeocoder')
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)()
+
+class RateLimiter(object):
+    """
+    Limit the rate at which any number of threads may proceed.
+    """
+    def __init__(self, qps):
+        self.interval = 1.0 / qps if qps else 0
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        """
+        Block until the next request may be made.
+        """
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+def geocode_addresses(addresses, geocoder=None, qps=None, workers=None):
+    """
+    Geocode a list of raw addresses.
+
+    Previously geocoded addresses are loaded from the GeocodedAddress table
+    with a single query. The remaining addresses are geocoded by a pool of
+    workers which together make at most `qps` requests per second, and
+    the results are saved for next time. Any error geocoding an address
+    is logged, and the address is left ungeocoded to be retried later.
+
+    :return: A dict of the given addresses mapped to GeocodedAddress
+             instances, or to None if they could not be geocoded.
+    """
+    geocoder = geocoder or get_geocoder()
+    qps = qps or getattr(settings, 'OLCC_GEOCODER_QPS', GEOCODER_QPS)
+    workers = workers or GEOCODER_WORKERS
+
+    keys = dict((address, normalize_address(address)) for address in addresses)
+
+    cached = dict((g.key, g) for g in
+            GeocodedAddress.objects.filter(key__in=set(keys.values())))
+
+    missing = sorted(set(keys.values()) - set(cached.keys()))
+    raw = dict((key, address) for address, key in keys.items())
+
+    limiter = RateLimiter(qps)
+
+    def geocode(key):
+        limiter.wait()
+        try:
+            return geocoder.geocode(raw[key])
+        except ValueError:
+            return None
+        except Exception:
+            # Don't lose the other addresses to a network or quota error
+            logger.warning("Unable to geocode '%s'", raw[key], exc_info=True)
+            return None
+
+    if missing:
+        pool = ThreadPool(min(workers, len(missing)))
+        try:
+            results = pool.map(geocode, missing)
+        finally:
+            pool.close()
+
+        for key, result in zip(missing, results):
+            if result:
+                address, pos = result
+                cached[key] = GeocodedAddress.objects.create(key=key,
+                        address=address.strip()[:200],
+                        latitude=str(pos[0]), longitude=str(pos[1]))
+
+    return dict((address, cached.get(key)) for address, key in keys.items())
@@ -0,0 +1,104 @@
+import datetime
+
+from olcc.models import ProductPrice
+
+# The most products whose history may be requested at once
+MAX_HISTORY_PRODUCTS = 50
+
+AGGREGATES = ('year',)
+
+def parse_date(value):
+    """
+    Return the date for a value formatted as YYYY-MM-DD or YYYY-MM.
+
+    :raises ValueError: If the value is not a valid date.
+    """
+    for format in ('%Y-%m-%d', '%Y-%m'):
+        try:
+            return datetime.datetime.strptime(value, format).date()
+        except ValueError:
+            pass
+    raise ValueError("Invalid date: %s" % value)
+
+def parse_history(params):
+    """
+    Return a tuple of the product ids, start date, end date and
+    aggregate to use from the given request parameters. Any of them
+    may be None, except for the product ids.
+
+    :raises ValueError: If the parameters are invalid.
+    """
+    try:
+        ids = [int(pk) for pk in params.get('ids', '').split(',') if pk]
+    except ValueError:
+        raise ValueError("Invalid product ids: %s" % params.get('ids'))
+
+    if len(ids) > MAX_HISTORY_PRODUCTS:
+        raise ValueError("At most %s products may be requested at once"
+                % MAX_HISTORY_PRODUCTS)
+
+    start = params.get('start')
+    start = parse_date(start) if start else None
+    end = params.get('end')
+    end = parse_date(end) if end else None
+
+    aggregate = params.get('aggregate') or None
+    if aggregate is not None and aggregate not in AGGREGATES:
+        raise ValueError("Invalid aggregate: %s" % aggregate)
+
+    return (ids, start, end, aggregate)
+
+def percent_change(first, last):
+    """
+    Return the percentage change between two prices, or None if the
+    first price is zero.
+    """
+    if not first:
+        return None
+    return round(float(last - first) / float(first) * 100, 2)
+
+def price_history(product_ids, start=None, end=None):
+    """
+    Return a dict mapping each of the given product ids to its price
+    history between the start and end dates, inclusive, as a dict of
+    `dates` and `amounts` lists, oldest first.
+
+    The prices of every product are read with a single query, which is
+    answered from the (product, effective_date, amount) index alone.
+    """
+    history = dict((pk, {'dates': [], 'amounts': []}) for pk in product_ids)
+
+    prices = ProductPrice.objects.filter(product__in=product_ids)
+    if start:
+        prices = prices.filter(effective_date__gte=start)
+    if end:
+        prices = prices.filter(effective_date__lte=end)
+
+    for pk, effective_date, amount in prices.order_by('product',
+            'effective_date').values_list('product', 'effective_date',
+                'amount'):
+        history[pk]['dates'].append(effective_date)
+        history[pk]['amounts'].append(amount)
+
+    return history
+
+def yearly_summary(dates, amounts):
+    """
+    Return the minimum, maximum and average price and the percentage
+    change over each year of a price history, as a dict of lists.
+    """
+    summary = {'years': [], 'min': [], 'max': [], 'avg': [], 'change': []}
+
+    years = {}
+    for date, amount in zip(dates, amounts):
+        years.setdefault(date.year, []).append(amount)
+
+    for year in sorted(years):
+        values = years[year]
+        summary['years'].append(year)
+        summary['min'].append(min(values))
+        summary['max'].append(max(values))
+        summary['avg'].append(round(float(sum(values)) / len(values), 2))
+        summary['change'].append(percent_change(values[0], values[-1]))
+
+    return summary
@@ -0,0 +1,274 @@
+import bisect
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.util import CursorWrapper
+from django.template.base import Template
+
+logger = logging.getLogger(__name__)
+
+# The most SQL statements kept per request for logging
+MAX_LOGGED_QUERIES = 100
+
+# The upper bounds of the histogram buckets for each metric
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+class CountingCursorWrapper(CursorWrapper):
+    """
+    A cursor which reports each query it runs to a QueryCounter.
+    """
+    def __init__(self, cursor, db, counter):
+        super(CountingCursorWrapper, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        self.set_dirty()
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.counter.add(time.time() - start, self.cursor, sql, params)
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.counter.add(time.time() - start, self.cursor, sql)
+
+class QueryCounter(object):
+    """
+    Count the queries run on a database connection and the time spent
+    running them.
+
+    Unlike the debug cursor used when DEBUG is on, the SQL of each query
+    is not kept, so a counter may be left running for any number of
+    queries without using more memory.
+
+    Use as a context manager::
+
+        with QueryCounter() as counter:
+            ...
+        print counter.count, counter.time
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS, keep_sql=0):
+        """
+        :param keep_sql: The number of SQL statements to keep in `sql`.
+        """
+        self.connection = connections[using]
+        self.count = 0
+        self.time = 0.0
+        self.keep_sql = keep_sql
+        self.sql = []
+
+    def add(self, duration, cursor=None, sql=None, params=None):
+        self.count += 1
+        self.time += duration
+
+        if sql and len(self.sql) < self.keep_sql:
+            if params is not None:
+                sql = self.connection.ops.last_executed_query(cursor, sql,
+                        params)
+            self.sql.append((duration, sql))
+
+    def wrap(self, cursor):
+        # Keep logging queries if they would have been logged anyway
+        if self.debug:
+            cursor = self.make_debug_cursor(cursor)
+        return CountingCursorWrapper(cursor, self.connection, self)
+
+    def __enter__(self):
+        conn = self.connection
+        self.saved = (conn.use_debug_cursor,
+                conn.__dict__.get('make_debug_cursor'))
+
+        self.debug = conn.use_debug_cursor or (
+                conn.use_debug_cursor is None and settings.DEBUG)
+        self.make_debug_cursor = conn.make_debug_cursor
+
+        conn.use_debug_cursor = True
+        conn.make_debug_cursor = self.wrap
+        return self
+
+    def __exit__(self, *exc_info):
+        conn = self.connection
+        conn.use_debug_cursor, make_debug_cursor = self.saved
+
+        if make_debug_cursor is None:
+            del conn.make_debug_cursor
+        else:
+            conn.make_debug_cursor = make_debug_cursor
+
+class Histogram(object):
+    """
+    A count of values falling within each of a fixed set of buckets.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        labels = ['<=%s' % b for b in self.bounds] + ['>%s' % self.bounds[-1]]
+        return {
+            'count': self.count,
+            'mean': round(float(self.total) / self.count, 2) if self.count else 0,
+            'max': round(self.max, 2),
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+class Stats(object):
+    """
+    Aggregated request metrics for each view in this process.
+    """
+    METRICS = (
+        ('latency_ms', LATENCY_BUCKETS),
+        ('db_ms', LATENCY_BUCKETS),
+        ('template_ms', LATENCY_BUCKETS),
+        ('queries', QUERY_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def add(self, view, **values):
+        with self.lock:
+            if view not in self.views:
+                self.views[view] = dict((name, Histogram(bounds)) for
+                        name, bounds in self.METRICS)
+
+            for name, value in values.items():
+                self.views[view][name].add(value)
+
+    def as_dict(self):
+        with self.lock:
+            return dict((view, dict((name, h.as_dict()) for name, h in
+                metrics.items())) for view, metrics in self.views.items())
+
+    def clear(self):
+        with self.lock:
+            self.views = {}
+
+# The metrics of every request handled by this process
+stats = Stats()
+
+# The metrics of the request being handled by the current thread
+_local = threading.local()
+
+class RequestMetrics(object):
+    """
+    The query count, database time and template rendering time of
+    a single request.
+    """
+    def __init__(self, keep_sql=0):
+        self.start = time.time()
+        self.view = None
+        self.template_time = 0.0
+        self.depth = 0
+        self.queries = QueryCounter(keep_sql=keep_sql)
+
+def instrument_templates():
+    """
+    Time the rendering of templates for the current request. Templates
+    included by another template are timed as part of their parent.
+    """
+    if getattr(Template.render, 'instrumented', False):
+        return
+
+    render = Template.render
+
+    def timed_render(self, context):
+        metrics = getattr(_local, 'metrics', None)
+        if metrics is None or metrics.depth:
+            return render(self, context)
+
+        metrics.depth += 1
+        start = time.time()
+        try:
+            return render(self, context)
+        finally:
+            metrics.template_time += time.time() - start
+            metrics.depth -= 1
+
+    timed_render.instrumented = True
+    Template.render = timed_render
+
+def view_name(view):
+    return '%s.%s' % (getattr(view, '__module__', None),
+            getattr(view, '__name__', view.__class__.__name__))
+
+class InstrumentationMiddleware(object):
+    """
+    Record the number of queries, the time spent running them, the time
+    spent rendering templates and the total time taken by each request.
+
+    The timings are sent with each response in a `Server-Timing` header
+    and aggregated per view in `stats`. Any view running more queries
+    than the OLCC_QUERY_BUDGET setting allows has its SQL logged.
+
+    This middleware should be listed first, so that the time taken by
+    any other middleware is included in the total.
+    """
+    def __init__(self):
+        self.budget = getattr(settings, 'OLCC_QUERY_BUDGET', None)
+        instrument_templates()
+
+    def process_request(self, request):
+        # Stop counting for an earlier request which was never finished
+        stale = getattr(_local, 'metrics', None)
+        if stale is not None:
+            stale.queries.__exit__(None, None, None)
+
+        keep_sql = MAX_LOGGED_QUERIES if self.budget is not None else 0
+        metrics = RequestMetrics(keep_sql=keep_sql)
+        metrics.queries.__enter__()
+
+        request._olcc_metrics = _local.metrics = metrics
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = getattr(request, '_olcc_metrics', None)
+        if metrics is not None:
+            metrics.view = view_name(view_func)
+
+    def process_response(self, request, response):
+        metrics = getattr(request, '_olcc_metrics', None)
+        if metrics is None:
+            return response
+
+        del request._olcc_metrics
+        _local.metrics = None
+        metrics.queries.__exit__(None, None, None)
+
+        total = (time.time() - metrics.start) * 1000
+        db = metrics.queries.time * 1000
+        template = metrics.template_time * 1000
+        count = metrics.queries.count
+        view = metrics.view or 'unresolved'
+
+        response['Server-Timing'] = 'db;dur=%.1f;desc="%d queries", ' \
+                'tpl;dur=%.1f, total;dur=%.1f' % (db, count, template, total)
+
+        stats.add(view, latency_ms=total, db_ms=db, template_ms=template,
+                queries=count)
+
+        if self.budget is not None and count > self.budget:
+            logger.warning("%s ran %d queries (budget %d) for %s:\n%s",
+                view, count, self.budget, request.get_full_path(),
+                '\n'.join('(%.1f ms) %s' % (d * 1000, sql) for d, sql in
+                    metrics.queries.sql))
+
+        return response
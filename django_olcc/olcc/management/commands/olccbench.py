@@ -0,0 +1,340 @@
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import string
+import subprocess
+import tempfile
+import time
+
+from contextlib import contextmanager
+from optparse import make_option
+
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.template import Context, Template
+from django.test.client import RequestFactory
+
+from olcc import caching, models, pagination
+from olcc.instrumentation import QueryCounter
+from olcc.models import add_months, Product, ProductPrice
+
+BENCHMARKS = ('activehref', 'import',)
+
+# Words used to build synthetic product titles
+TITLE_WORDS = ('OLD', 'KENTUCKY', 'RESERVE', 'SINGLE', 'MALT', 'SCOTCH',
+        'BOURBON', 'RYE', 'GIN', 'LONDON', 'DRY', 'VODKA', 'CITRUS', 'RUM',
+        'SPICED', 'DARK', 'TEQUILA', 'REPOSADO', 'ANEJO', 'BRANDY', 'CREAM',
+        'ORANGE', 'LIQUEUR', 'SENOR', 'RIO', 'COLD', 'TREE', 'OVERHOLT')
+SIZES = ('50 ML', '375 ML', '750 ML', '1 L', '1.75 L')
+AGES = ('', '', '', '6 MOS', '4 YRS', '12 YRS', '18 YRS')
+STATUSES = ('', '', '@', '#')
+
+# The most rows an XLS worksheet can hold
+XLS_MAX_ROWS = 65536
+
+NAV_TEMPLATE = """{% load olcc %}
+{% activehref %}
+<li><a href="{% url home %}">Oregon Liquor Prices</a></li>
+<li><a href="{% url products %}">Products</a></li>
+<li><a href="{% url sale %}">On Sale</a></li>
+<li><a href="{% url stores %}">Stores</a></li>
+{% endactivehref %}"""
+
+def price_rows(products, months=1, seed=0):
+    """
+    Yield rows of synthetic OLCC price list data in the column order of
+    the numeric price list, for the given number of products.
+
+    When `months` is greater than one a price history is generated,
+    listing every product once per month ending with next month.
+    """
+    rand = random.Random(seed)
+    next_month = add_months(datetime.date.today().replace(day=1), 1)
+
+    catalog = []
+    for i in xrange(products):
+        code = '%05d%s' % (i % 100000, string.ascii_uppercase[i // 100000 % 26])
+        title = ' '.join(rand.sample(TITLE_WORDS, rand.randint(2, 4)))
+        catalog.append((code, rand.choice(STATUSES), title, rand.choice(SIZES),
+            rand.choice(AGES), rand.choice((70, 80, 90, 100)),
+            rand.choice((6, 12, 24)), rand.uniform(8, 80)))
+
+    for month in reversed(range(months)):
+        date = add_months(next_month, -month).strftime('%m/%d/%Y')
+
+        for code, status, title, size, age, proof, per_case, price in catalog:
+            # Prices drift a little from month to month
+            price *= rand.uniform(0.9, 1.1)
+            yield (code, status, title, size, age, proof, per_case,
+                    '%.2f' % price, date)
+
+def write_price_csv(path, rows):
+    """
+    Write rows of price list data to a CSV file.
+    """
+    with open(path, 'wb') as f:
+        csv.writer(f).writerows(rows)
+
+def write_price_xls(path, rows):
+    """
+    Write rows of price list data to the first sheet of an Excel workbook.
+    """
+    import xlwt
+
+    wb = xlwt.Workbook()
+    sheet = wb.add_sheet('Prices')
+    for n, row in enumerate(rows):
+        for col, value in enumerate(row):
+            sheet.write(n, col, value)
+    wb.save(path)
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in kilobytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        # Reported in bytes rather than kilobytes
+        rss //= 1024
+    return rss
+
+def git_revision():
+    """
+    Return the current git commit, if any.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@contextmanager
+def private_cache():
+    """
+    Use a local memory cache in place of the configured cache, so that
+    the cache generation bumped and the sample pools cleared by each
+    import don't expire the pages cached for the site.
+    """
+    local = get_cache('django.core.cache.backends.locmem.LocMemCache',
+            LOCATION='olccbench')
+    modules = (caching, models, pagination)
+
+    saved = [module.cache for module in modules]
+    for module in modules:
+        module.cache = local
+
+    try:
+        yield local
+    finally:
+        for module, cache in zip(modules, saved):
+            module.cache = cache
+
+class Command(BaseCommand):
+    """
+    This command runs micro-benchmarks of performance sensitive code,
+    and end to end benchmarks of the import commands.
+    """
+    args = "<benchmark benchmark ...>"
+    help = "Runs the given benchmarks: %s" % (', '.join(BENCHMARKS),)
+
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', action='store', type='int',
+            dest='iterations', default=10000,
+            help='The number of times to run each benchmark.'),
+        make_option('--sizes', action='store', dest='sizes',
+            default='5000,50000,500000',
+            help='The comma separated numbers of products in the price lists '
+                'imported by the import benchmark.'),
+        make_option('--history-products', action='store', type='int',
+            dest='history_products', default=5000,
+            help='The number of products in the imported price history. '
+                'Use 0 to skip the history import.'),
+        make_option('--history-years', action='store', type='int',
+            dest='history_years', default=3,
+            help='The number of years of monthly prices in the imported '
+                'price history.'),
+        make_option('--row-by-row', action='store_false', dest='bulk',
+            default=True, help='Benchmark row by row rather than bulk '
+                'price imports.'),
+        make_option('--output', action='store', dest='output', default=None,
+            help='Write the import benchmark results to the given JSON file.'),
+    )
+
+    def uprint(self, msg):
+        """
+        Unbuffered print.
+        """
+        self.stdout.write("%s\n" % msg)
+        self.stdout.flush()
+
+    def timeit(self, name, func):
+        """
+        Call the given function once per iteration and print the
+        average time taken.
+        """
+        func()
+
+        start = time.time()
+        for i in xrange(self.iterations):
+            func()
+        elapsed = time.time() - start
+
+        self.uprint("%-30s %10.2f usec/call" % (name,
+            elapsed / self.iterations * 1000000))
+
+    def bench_activehref(self):
+        """
+        Compare rendering the 'activehref' tag used by the site navigation
+        with re-parsing its content using BeautifulSoup.
+        """
+        request = RequestFactory().get('/products/')
+        context = Context({'request': request})
+        nav = Template(NAV_TEMPLATE)
+
+        self.timeit('activehref', lambda: nav.render(context))
+
+        try:
+            from bs4 import BeautifulSoup
+        except ImportError:
+            self.uprint("Install beautifulsoup4 to compare with a parser.")
+            return
+
+        content = Template(NAV_TEMPLATE.replace('{% activehref %}', '')\
+                .replace('{% endactivehref %}', ''))
+
+        def soup():
+            soup = BeautifulSoup(content.render(context))
+            for a in soup.find_all('a'):
+                if a['href'] != '/' and a['href'] in request.path:
+                    a['class'] = 'active'
+                    break
+            return unicode(soup)
+
+        self.timeit('activehref (BeautifulSoup)', soup)
+
+    def run_import(self, name, path, import_type, rows):
+        """
+        Time a single import of the given file end to end, counting the
+        queries it runs and measuring its memory use.
+
+        :return: A dict of results.
+        """
+        rss = peak_rss()
+
+        with QueryCounter() as counter:
+            start = time.time()
+            call_command('olccimport', path, import_type=import_type,
+                    bulk=self.bulk, quiet=True)
+            elapsed = time.time() - start
+
+        result = {
+            'name': name,
+            'import_type': import_type,
+            'bulk': self.bulk,
+            'rows': rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed, 1) if elapsed else None,
+            'queries': counter.count,
+            'query_seconds': round(counter.time, 3),
+            'peak_rss_kb': peak_rss(),
+            'rss_growth_kb': peak_rss() - rss,
+            'products': Product.objects.count(),
+            'prices': ProductPrice.objects.count(),
+        }
+
+        self.uprint("%-20s %8d rows %9.2f sec %10.1f rows/sec %8d queries "
+                "%8d KB peak RSS" % (name, rows, elapsed,
+                    result['rows_per_second'] or 0, counter.count,
+                    result['peak_rss_kb']))
+
+        return result
+
+    def import_datasets(self, tmpdir):
+        """
+        Yield the name, path, import type and number of rows of each
+        synthetic file to import, writing each file when it is needed.
+        """
+        try:
+            import xlwt
+        except ImportError:
+            xlwt = None
+            self.uprint("Install xlwt to benchmark Excel imports.")
+
+        for size in self.sizes:
+            path = os.path.join(tmpdir, 'prices-%s.csv' % size)
+            write_price_csv(path, price_rows(size))
+            yield ('csv_prices_%s' % size, path, 'csv_prices', size)
+
+            if xlwt and size < XLS_MAX_ROWS:
+                path = os.path.join(tmpdir, 'prices-%s.xls' % size)
+                write_price_xls(path, price_rows(size))
+                yield ('prices_%s' % size, path, 'prices', size)
+
+        if self.history_products:
+            months = self.history_years * 12
+            path = os.path.join(tmpdir, 'history.csv')
+            write_price_csv(path, price_rows(self.history_products, months))
+            yield ('csv_history_%sy' % self.history_years, path, 'csv_prices',
+                    self.history_products * months)
+
+    def bench_import(self):
+        """
+        Import synthetic price lists of increasing size into a fresh
+        test database and a private cache, recording the time, queries
+        and memory each takes.
+
+        Peak RSS is measured for the whole process, so the growth during
+        each import is also recorded.
+        """
+        old_name = connection.creation.create_test_db(verbosity=0,
+                autoclobber=True)
+        tmpdir = tempfile.mkdtemp()
+
+        results = []
+        try:
+            with private_cache():
+                for name, path, import_type, rows in \
+                        self.import_datasets(tmpdir):
+                    call_command('flush', interactive=False, verbosity=0)
+                    results.append(self.run_import(name, path, import_type,
+                        rows))
+                    os.remove(path)
+        finally:
+            shutil.rmtree(tmpdir)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if self.output:
+            with open(self.output, 'w') as f:
+                json.dump({
+                    'revision': git_revision(),
+                    'date': datetime.datetime.now().isoformat(),
+                    'database': connection.vendor,
+                    'python': platform.python_version(),
+                    'results': results,
+                }, f, indent=2)
+            self.uprint("Wrote results to %s" % self.output)
+
+    def handle(self, *args, **options):
+        self.iterations = options.get('iterations')
+        self.bulk = options.get('bulk', True)
+        self.history_products = options.get('history_products')
+        self.history_years = options.get('history_years')
+        self.output = options.get('output')
+
+        try:
+            self.sizes = [int(s) for s in options.get('sizes').split(',') if s]
+        except ValueError:
+            raise CommandError("Invalid sizes: %s" % options.get('sizes'))
+
+        for name in args or BENCHMARKS:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark '%s'!" % name)
+
+            getattr(self, 'bench_%s' % name)()
@@ -1,7 +1,15 @@
+import base64
+import hashlib
+import json
 import os
+import re
 import requests
+import socket
 import tempfile
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django.conf import settings
@@ -10,6 +18,25 @@ from django.core.management.base import BaseCommand, CommandError
 
 from olcc.models import ImportRecord
 from olcc.management.commands.olccimport import IMPORT_TYPES
+from olcc.management.progress import Progress
+
+# The order in which files from a manifest are imported
+IMPORT_ORDER = ('stores', 'csv_prices', 'prices',)
+
+# The default number of bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+
+class DownloadError(Exception):
+    """
+    Raised when a downloaded file is incomplete or corrupt, or when the
+    server fails with a 5xx error, all of which are worth retrying.
+
+    :param restart: True if the download must be started over instead of
+                    being resumed.
+    """
+    def __init__(self, msg, restart=False):
+        super(DownloadError, self).__init__(msg)
+        self.restart = restart
 
 class Command(BaseCommand):
     help = """\
@@ -17,7 +44,16 @@ class Command(BaseCommand):
         directory. The file should be in the format of an Excel spreadsheet
         containing an OLCC price list, price history or store list.
         If the file has changed since it was last fetched, a new import
-        will be started."""
+        will be started.
+
+        Several files can be fetched at once by listing them in a JSON
+        manifest, for example:
+
+            [{"url": "http://example.com/stores.xls", "import_type": "stores"},
+             {"url": "http://example.com/prices.csv", "import_type": "csv_prices"}]
+
+        The files are downloaded concurrently, then imported in the order
+        stores, prices, before running 'olccperiodic'."""
 
     option_list = BaseCommand.option_list + (
         make_option('--quiet', action='store_true', dest='quiet',
@@ -29,6 +65,20 @@ class Command(BaseCommand):
         make_option('--import-type', choices=IMPORT_TYPES,
             dest='import_type', default='csv_prices',
             help='One of the following: %s' % (', '.join(IMPORT_TYPES),)),
+        make_option('--manifest', action='store', type='string',
+            dest='manifest', help='A JSON file listing the url and '
+                'import_type of each file to fetch.'),
+        make_option('--retries', action='store', type='int',
+            dest='retries', default=3,
+            help='The number of times to retry an interrupted download or '
+                'a server error.'),
+        make_option('--backoff', action='store', type='float',
+            dest='backoff', default=1.0,
+            help='The number of seconds to wait before the first retry. '
+                'The delay doubles after each retry.'),
+        make_option('--chunk-size', action='store', type='int',
+            dest='chunk_size', default=CHUNK_SIZE,
+            help='The number of bytes to read from the server at a time.'),
     )
 
     def uprint(self, msg):
@@ -39,73 +89,315 @@ class Command(BaseCommand):
             self.stdout.write("%s\n" % msg)
             self.stdout.flush()
 
-    def handle(self, *args, **options):
-        self.quiet = options.get('quiet', False)
-        force = options.get('force', False)
-        url = options.get('url')
-        import_type = options.get('import_type')
+    def load_manifest(self, filename):
+        """
+        Load a list of sources from the given JSON manifest.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                sources = json.load(f)
+        except IOError, e:
+            raise CommandError("No such file: '%s'" % e.filename)
+        except ValueError, e:
+            raise CommandError("Invalid manifest: %s" % e)
+
+        for source in sources:
+            if source.get('import_type') not in IMPORT_TYPES or \
+                    not source.get('url'):
+                raise CommandError("Invalid manifest entry: %s" % source)
+
+        return sources
+
+    def verify(self, r, size, md5, resumed):
+        """
+        Verify a downloaded file against the length and checksum reported
+        by the server, raising a DownloadError if they do not match.
+        """
+        total = r.headers.get('content-length')
+
+        content_range = r.headers.get('content-range')
+        if resumed and content_range:
+            m = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+            total = m and m.group(1)
+        elif resumed:
+            total = None
+
+        if total and int(total) != size:
+            raise DownloadError("Expected %s bytes but received %s!" % (
+                total, size))
 
-        if not url:
-            # Get default URL from settings!
-            url = getattr(settings, 'OLCC_PRICE_LIST_URL')
+        content_md5 = r.headers.get('content-md5')
+        if content_md5 and not resumed and \
+                base64.b64decode(content_md5) != md5.digest():
+            raise DownloadError("Checksum mismatch!", restart=True)
+
+    def download(self, url, previous_import):
+        """
+        Download the file at the given URL to a new temp file, unless the
+        server reports that it has not changed since the previous import.
+        Interrupted downloads and server errors are retried with an
+        exponential backoff, and resumed from the bytes already on disk
+        with a Range request. The temp file is removed if the download
+        fails.
+
+        This method does not touch the database, so it may be called
+        from any thread.
+
+        :return: A tuple containing the path to the temp file, the ETag, the
+                 md5 hexdigest of the file and the Last-Modified header or
+                 None if not modified.
+        """
+        # Make a conditional request for the given URL, so that the
+        # server only returns the file if it has changed. The server's own
+        # Last-Modified date is sent back, since our clock may not match.
+        conditional_headers = {}
+        if previous_import and not self.force:
+            if previous_import.etag:
+                conditional_headers['If-None-Match'] = \
+                        '"%s"' % previous_import.etag
+            if previous_import.last_modified:
+                conditional_headers['If-Modified-Since'] = \
+                        previous_import.last_modified
+
+        # Create a temp file
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        etag = ""
+        last_modified = ""
+        size = 0
+        md5 = hashlib.md5()
+        attempt = 0
 
         try:
-            previous_import = None
-            try:
-                previous_import = ImportRecord.objects.filter(\
-                        url=url).latest('created_at')
-            except ImportRecord.DoesNotExist:
-                pass
-
-            # Make a HEAD request for the given URL
-            r = requests.get(url, timeout=5, prefetch=False)
-
-            # Get the ETag for the resource
-            etag = ""
-            if r.headers.has_key('etag'):
-                etag = r.headers.get('etag')
-                etag = etag.strip('"')
-            else:
-                print "The server did not include an ETag in the response!"
-
-            # Determine if we should run the import
-            should_import = False
-
-            if not previous_import or (etag != previous_import.etag):
-                should_import = True
-
-            if should_import or force:
-                self.uprint('Starting import from:\n\t"%s"' % url)
-
-                # Create a temp file
-                fd, path = tempfile.mkstemp()
-
-                with os.fdopen(fd, 'wb') as f:
-                    # Write to the temp file
-                    for chunk in r.iter_content(chunk_size=10240):
-                        f.write(chunk)
-
-                    # Create new import record
-                    new_import = ImportRecord()
-                    new_import.url = url
-                    new_import.etag = etag
-                    new_import.save()
-
-                # Start a new import. This must be done outside of the
-                # context manager block above, so that the file handle
-                # can be fully closed before 'olccimport' tries to
-                # open a new one.
-                call_command('olccimport', path, import_type=import_type,
-                        quiet=self.quiet)
-            else:
-                self.uprint("File not modified, skipping import.")
+            while True:
+                if size:
+                    # Resume the download, unless the file has changed
+                    headers = {'Range': 'bytes=%s-' % size}
+                    if etag:
+                        headers['If-Range'] = '"%s"' % etag
+                else:
+                    headers = conditional_headers
+
+                try:
+                    r = requests.get(url, timeout=5, prefetch=False,
+                            headers=headers)
+
+                    if r.status_code == 304:
+                        os.remove(path)
+                        return None
+
+                    if r.status_code >= 500:
+                        raise DownloadError("Server error %s!" % r.status_code)
+
+                    r.raise_for_status()
+
+                    resumed = bool(size) and r.status_code == 206
+
+                    if not resumed:
+                        # Get the ETag for the resource
+                        etag = ""
+                        if r.headers.has_key('etag'):
+                            etag = r.headers.get('etag')
+                            etag = etag.strip('"')
+                        else:
+                            print "The server did not include an ETag in the response!"
+
+                        last_modified = r.headers.get('last-modified') or ""
+
+                        if previous_import and not self.force and \
+                                etag == previous_import.etag:
+                            os.remove(path)
+                            return None
+
+                        # Start the file over
+                        size = 0
+                        md5 = hashlib.md5()
+
+                    with open(path, 'ab' if resumed else 'wb') as f:
+                        # Write to the temp file, calculating its checksum
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+                            md5.update(chunk)
+                            size += len(chunk)
+
+                    self.verify(r, size, md5, resumed)
+
+                    return (path, etag, md5.hexdigest(), last_modified)
+                except (requests.ConnectionError, requests.Timeout,
+                        socket.error, DownloadError), e:
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+
+                    if getattr(e, 'restart', False):
+                        size = 0
+
+                    with self.lock:
+                        self.retried[url] = self.retried.get(url, 0) + 1
+
+                    delay = self.backoff * 2 ** (attempt - 1)
+                    print "Download of '%s' failed (%s), retrying in %s seconds ..." % (
+                            url, e, delay)
+                    time.sleep(delay)
+        except:
+            # Don't leave a partial download behind
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+    def fetch(self, source):
+        """
+        Download the file for the given source, reporting any errors.
+        The time taken is recorded as the source's `download_time`, and
+        the reason for a failed download as its `error`.
+
+        :return: The result of `download` or None.
+        """
+        url = source['url']
+        start = time.time()
+
+        try:
+            return self.download(url, source['previous_import'])
         except requests.exceptions.MissingSchema:
-            print "Request failed! Invalid URL."
+            error = "Invalid URL."
         except requests.ConnectionError:
-            print "Request failed! ConnectionError."
+            error = "ConnectionError."
         except requests.HTTPError:
-            print "Request failed! HTTPError."
+            error = "HTTPError."
         except requests.Timeout:
-            print "Request failed! Timeout."
+            error = "Timeout."
         except requests.TooManyRedirects:
-            print "Request failed! TooManyRedirects."
+            error = "TooManyRedirects."
+        except DownloadError, e:
+            error = str(e)
+        finally:
+            source['download_time'] = time.time() - start
+
+        print "Request failed! %s" % error
+        source['error'] = error
+
+    def handle(self, *args, **options):
+        self.quiet = options.get('quiet', False)
+        self.force = options.get('force', False)
+        self.retries = options.get('retries')
+        self.backoff = options.get('backoff')
+        self.chunk_size = options.get('chunk_size')
+        url = options.get('url')
+        import_type = options.get('import_type')
+        manifest = options.get('manifest')
+
+        # The number of times each download was retried
+        self.lock = threading.Lock()
+        self.retried = {}
+
+        if manifest:
+            sources = self.load_manifest(manifest)
+        else:
+            if not url:
+                # Get default URL from settings!
+                url = getattr(settings, 'OLCC_PRICE_LIST_URL')
+
+            sources = [{'url': url, 'import_type': import_type}]
+
+        # Find the previous import for each source
+        for source in sources:
+            try:
+                source['previous_import'] = ImportRecord.objects.filter(\
+                        url=source['url']).latest('created_at')
+            except ImportRecord.DoesNotExist:
+                source['previous_import'] = None
+
+        # Download all of the files at once
+        if len(sources) > 1:
+            pool = ThreadPool(len(sources))
+            try:
+                results = pool.map(self.fetch, sources)
+            finally:
+                pool.close()
+        else:
+            results = [self.fetch(sources[0])]
+
+        failed = [source for source in sources if source.get('error')]
+
+        imports = []
+        for source, result in zip(sources, results):
+            if source.get('error'):
+                continue
+
+            if result is None:
+                self.uprint('File not modified, skipping import from:\n\t"%s"'
+                        % source['url'])
+                continue
+
+            path, etag, checksum, last_modified = result
+            previous_import = source['previous_import']
+
+            if previous_import and not self.force and \
+                    checksum == previous_import.local_checksum:
+                # The server returned a new ETag for the same content.
+                # Remember the new ETag so that the next request can
+                # be answered with a 304.
+                previous_import.etag = etag
+                previous_import.last_modified = last_modified
+                previous_import.save()
+                os.remove(path)
+
+                self.uprint('File content not modified, skipping import '
+                        'from:\n\t"%s"' % source['url'])
+                continue
+
+            imports.append((source, path, etag, checksum, last_modified))
+
+        # Import stores before prices
+        imports.sort(key=lambda item: IMPORT_ORDER.index(
+            item[0]['import_type']))
+
+        if failed:
+            # Skip any imports which should follow a failed download, so
+            # that they are retried together by the next fetch.
+            first = min(IMPORT_ORDER.index(source['import_type']) for
+                    source in failed)
+
+            for source, path, etag, checksum, last_modified in imports[:]:
+                if IMPORT_ORDER.index(source['import_type']) > first:
+                    imports.remove((source, path, etag, checksum,
+                        last_modified))
+                    os.remove(path)
+
+                    self.uprint('Skipping import from:\n\t"%s"\n'
+                            'since an earlier download failed.' % source['url'])
+
+        for source, path, etag, checksum, last_modified in imports:
+            self.uprint('Starting import from:\n\t"%s"' % source['url'])
+
+            # Report the download as part of the import
+            progress = Progress(self.stdout, self.quiet)
+            progress.add_time('download', source['download_time'])
+            progress.count('bytes', os.path.getsize(path))
+            if source['url'] in self.retried:
+                progress.count('retries', self.retried[source['url']])
+
+            call_command('olccimport', path,
+                    import_type=source['import_type'], quiet=self.quiet,
+                    progress=progress)
+
+            # Create new import record, only once the import has succeeded
+            # so that a failed import will be retried.
+            new_import = ImportRecord()
+            new_import.url = source['url']
+            new_import.etag = etag
+            new_import.local_checksum = checksum
+            new_import.last_modified = last_modified
+            new_import.summary = json.dumps(progress.summary())
+            new_import.save()
+
+        if manifest and imports and not failed:
+            # Refresh the sale flags and price movers now, rather than
+            # waiting for the first of the month
+            call_command('olccperiodic', quiet=self.quiet, force=True)
+
+        if failed:
+            raise CommandError("Failed to download:\n\t%s" % '\n\t'.join(
+                "%s (%s)" % (source['url'], source['error']) for
+                    source in failed))
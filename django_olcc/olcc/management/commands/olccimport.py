@@ -1,18 +1,109 @@
 import datetime
 import os
-import time
 import xlrd
 import csv
 import re
 
+from decimal import Decimal
+from itertools import islice
+
 from django.core.management.base import BaseCommand, CommandError
-from django.db import IntegrityError, transaction
-from geopy import geocoders
-from olcc.models import Product, ProductPrice, Store
+from django.db import connection, IntegrityError, transaction
+from django.template.defaultfilters import slugify
+from olcc.caching import bump_generation, check_cache_size
+from olcc.geocoding import geocode_addresses
+from olcc.management.progress import Progress
+from olcc.models import add_months, Product, ProductPrice, Store
 from optparse import make_option
 
 IMPORT_TYPES = ('csv_prices', 'prices', 'stores',)
 
+PRICE_KEYS = ['code', 'status', 'title', 'size', 'age', 'proof', 'per_case',
+        'price', 'price_effective_date']
+
+# The default number of rows written per transaction by a bulk import
+CHUNK_SIZE = 1000
+
+def chunks(iterable, size):
+    """
+    Yield successive lists of at most `size` items from the given iterable.
+    If `size` is None a single list of every item is yielded.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def batch_size(model):
+    """
+    Return the number of model instances that can safely be written
+    with a single statement. SQLite limits the number of bound
+    parameters per query to 999.
+    """
+    if connection.vendor == 'sqlite':
+        return max(1, 999 // len(model._meta.local_fields))
+    return 1000
+
+def filter_in(queryset, field, values):
+    """
+    Yield the results of filtering the queryset with a `field__in` lookup,
+    splitting the values over as many queries as needed.
+    """
+    for chunk in chunks(values, 900):
+        for obj in queryset.filter(**{'%s__in' % field: chunk}):
+            yield obj
+
+def bulk_insert(model, objs):
+    """
+    Insert the given model instances with as few queries as possible.
+    """
+    for chunk in chunks(objs, batch_size(model)):
+        model.objects.bulk_create(chunk)
+
+def bulk_update(model, changed):
+    """
+    Update the given model instances with as few queries as possible.
+    Each chunk of instances is written with a single UPDATE, which sets
+    every changed column with a CASE on the primary key.
+
+    :param changed: A dict of primary keys mapped to dicts of the changed
+                    field values.
+    """
+    qn = connection.ops.quote_name
+    pk = qn(model._meta.pk.column)
+
+    # Each instance binds its primary key and up to two values per field
+    size = None
+    if connection.vendor == 'sqlite':
+        size = max(1, 999 // (2 * len(model._meta.local_fields) + 1))
+
+    cursor = connection.cursor()
+    for chunk in chunks(sorted(changed.items()), size):
+        columns = {}
+        for obj_pk, values in chunk:
+            for name, value in values.items():
+                field = model._meta.get_field(name)
+                value = field.get_db_prep_save(value, connection=connection)
+                columns.setdefault(field.column, []).extend([obj_pk, value])
+
+        assignments = []
+        params = []
+        for column, when in sorted(columns.items()):
+            assignments.append("%s = CASE %s %s ELSE %s END" % (qn(column),
+                pk, " ".join(["WHEN %s THEN %s"] * (len(when) // 2)),
+                qn(column)))
+            params.extend(when)
+
+        pks = [obj_pk for obj_pk, values in chunk]
+        params.extend(pks)
+        cursor.execute("UPDATE %s SET %s WHERE %s IN (%s)" % (
+            qn(model._meta.db_table), ", ".join(assignments), pk,
+            ", ".join(["%s"] * len(pks))), params)
+
+    transaction.commit_unless_managed()
+
 class Command(BaseCommand):
     """
     This command parses an Excel spreadsheet containing OLCC product
@@ -28,7 +119,20 @@ class Command(BaseCommand):
             dest='import_type', default='prices',
             help='One of the following: %s' % (', '.join(IMPORT_TYPES),)),
         make_option('--geocode', action='store_true', dest='geocode',
-            default=True, help='Geocode store addresses')
+            default=True, help='Geocode store addresses'),
+        make_option('--geocode-qps', action='store', type='float',
+            dest='geocode_qps', help='The most geocoding requests to make '
+                'per second. Defaults to the OLCC_GEOCODER_QPS setting.'),
+        make_option('--geocode-workers', action='store', type='int',
+            dest='geocode_workers',
+            help='The number of addresses to geocode at once.'),
+        make_option('--bulk', action='store_true', dest='bulk',
+            default=False, help='Import prices in batches instead of '
+                'row by row.'),
+        make_option('--chunk-size', action='store', type='int',
+            dest='chunk_size', default=CHUNK_SIZE,
+            help='The number of rows written per transaction by a bulk '
+                'import. Use 0 to write the whole file in one transaction.'),
     )
 
     def uprint(self, msg):
@@ -39,6 +143,57 @@ class Command(BaseCommand):
             self.stdout.write("%s\n" % msg)
             self.stdout.flush()
 
+    def parse_price_row(self, row):
+        """
+        Normalize a row of product price data.
+
+        :param row: A dict of keys mapped to row values.
+        :return: A dict with the product code, title, any product fields to
+                 update, the price amount and the price effective date or
+                 None if the row does not contain a valid product code.
+        """
+        if not Product.is_code_valid(row.get('code') or ''):
+            return None
+
+        fields = {}
+        if row.get('status'):
+            fields['status'] = row.get('status')
+        if row.get('size'):
+            fields['size'] = row.get('size')
+        if row.get('per_case'):
+            fields['bottles_per_case'] = int(float(row.get('per_case')))
+        if row.get('proof'):
+            fields['proof'] = row.get('proof')
+        if row.get('age'):
+            # example values: '14 YRS', '1 YR', '8 MOS'
+            m = re.search('(\\d+) (YRS?|MOS?)', row.get('age'))
+            if m and m.group(2).startswith('MO'):
+                fields['age'] = int(float(m.group(1))) / 12
+            elif m and m.group(2).startswith('YR'):
+                fields['age'] = m.group(1)
+
+        # Get the effective date for the new product price
+        if row.get('price_effective_date'):
+            price_date = datetime.datetime.strptime(
+                    row.get('price_effective_date'), '%m/%d/%Y').date()
+        elif row.get('year') and row.get('month'):
+            price_date = datetime.date(int(float(row.get('year'))),
+                int(float(row.get('month'))), 1)
+        else:
+            # Effective date is next month
+            price_date = add_months(datetime.date.today(), 1)
+
+        # Strip any other values from the price like commas
+        price = re.sub('[^0-9\.]', '', row.get('price') or '')
+
+        return {
+            'code': row.get('code'),
+            'title': row.get('title') or '',
+            'fields': fields,
+            'price': price,
+            'price_date': price_date,
+        }
+
     @transaction.commit_on_success
     def product_from_row(self, row):
         """
@@ -52,169 +207,325 @@ class Command(BaseCommand):
         product = None
         created = False
 
-        if Product.is_code_valid(row.get('code')):
-            product, created = Product.objects.get_or_create(code=row.get('code'))
+        data = self.parse_price_row(row)
+
+        if data:
+            product, created = Product.objects.get_or_create(code=data['code'])
 
             if created:
                 # Set the product title once and once only
-                product.title = row.get('title')
+                product.title = data['title']
 
             # Update our product
-            if row.get('status'):
-                product.status = row.get('status')
-            if row.get('size'):
-                product.size = row.get('size')
-            if row.get('per_case'):
-                product.bottles_per_case = int(float(row.get('per_case')))
-            if row.get('proof'):
-                product.proof = row.get('proof')
-            if row.get('age'):
-                # example values: '14 YRS', '1 YR', '8 MOS'
-                m = re.search('(\\d+) (YRS?|MOS?)', row.get('age'))
-                if m.group(2).startswith('MO'):
-                    product.age = int(float(m.group(1))) / 12
-                elif m.group(2).startswith('YR'):
-                    product.age = m.group(1)
+            for name, value in data['fields'].items():
+                setattr(product, name, value)
 
             # Persist our updates
             product.save()
 
-            # Get the effective date for the new product price
-            today = datetime.date.today()
-
-            if row.get('price_effective_date'):
-                price_date = datetime.datetime.strptime(
-                        row.get('price_effective_date'), '%m/%d/%Y')
-            elif row.get('year') and row.get('month'):
-                price_date = datetime.date(int(float(row.get('year'))),
-                    int(float(row.get('month'))), 1) 
-            else:
-                try:
-                    next_month = today.replace(month=today.month+1, day=1)
-                except ValueError:
-                    if today.month == 12:
-                        next_month = today.replace(year=today.year+1, month=1, day=1)
-
-                # Effective date is next month
-                price_date = next_month
-
             # Create the new price record
             try:
-                # Strip any other values from the price like commas
-                price = re.sub('[^0-9\.]', '', row.get('price'))
-
-                ProductPrice.objects.create(amount=str(price),
-                        effective_date=price_date, product=product)
+                if data['price']:
+                    ProductPrice.objects.create(amount=str(data['price']),
+                            effective_date=data['price_date'], product=product)
             except IntegrityError:
                 pass
 
         return (product, created)
 
-    def import_csv_prices(self, csvreader):
+    def normalize_rows(self, rows):
         """
-        Import a list of price and product data from the given CSV reader.
+        Strip any leading or trailing whitespace from the row values and
+        map our keys to the row values, skipping any empty rows.
         """
-        keys = ['code', 'status', 'title', 'size', 'age', 'proof', 'per_case',
-                'price', 'price_effective_date']
+        for values in rows:
+            self.progress.advance()
+            if len(values) > 0:
+                yield dict(zip(PRICE_KEYS, [str(s).strip() for s in values]))
 
-        count = 0
-        for row in csvreader:
-            if len(row) == 0:
+    def validate_rows(self, rows):
+        """
+        Parse each row of product price data, skipping any rows that
+        do not contain a valid product.
+        """
+        for row in rows:
+            try:
+                data = self.parse_price_row(row)
+            except ValueError, e:
+                self.progress.count('invalid_rows')
+                print "Invalid row for product code '%s': %s" % (row.get('code'), e)
                 continue
 
-            # Strip any leading or trailing whitespace from the row values
-            values = [str(s).strip() for s in row]
+            if data:
+                yield data
 
-            # Map our keys to the row values
-            obj = dict(zip(keys, values))
+    @transaction.commit_on_success
+    def write_price_chunk(self, items):
+        """
+        Write a chunk of parsed product price data with a constant number
+        of queries in a single transaction.
 
-            # Import our product
-            try:
-                product, created = self.product_from_row(obj)
+        The existing products for the chunk are loaded with a single query
+        and diffed against the incoming rows. New products and prices are
+        written with bulk inserts, and changed products are updated in
+        batches of identical values.
 
-                if product:
-                    count += 1
-                    self.uprint("[%s]: %s" % (product.code, product.title))
-            except Product.MultipleObjectsReturned:
-                print "Product code '%s' returned multiple results!" % obj['code']
+        :param items: A list of dicts as returned by `parse_price_row`.
+        :return: A tuple containing the number of created products, updated
+                 products and created prices.
+        """
+        codes = set(data['code'] for data in items)
+        products = dict((p.code, p) for p in
+                filter_in(Product.objects.all(), 'code', list(codes)))
 
-        self.uprint("\nImported '%s' new product records and/or prices!" % count)
+        new_products = {}
+        changed = {}
+        prices = {}
 
-        if count < 1:
-            self.uprint("\nDid you specify the correct import type?")
+        for data in items:
+            code = data['code']
+            product = products.get(code)
 
-    def import_prices(self, sheet):
+            if product is None:
+                # Set the product title once and once only
+                product = Product(code=code,
+                        title=Product.format_title(data['title']),
+                        slug=slugify(code))
+                products[code] = product
+                new_products[code] = product
+
+            for name, value in data['fields'].items():
+                field = product._meta.get_field(name)
+                value = field.to_python(value)
+                if getattr(product, name) != value:
+                    setattr(product, name, value)
+                    if code not in new_products:
+                        changed.setdefault(code, {})[name] = value
+
+            # The first price for a given date wins
+            if data['price']:
+                prices.setdefault((code, data['price_date']), data['price'])
+
+        # Insert our new products
+        bulk_insert(Product, new_products.values())
+
+        # Update changed products, grouping them by their new values
+        # so that each distinct set of values costs a single query.
+        groups = {}
+        for code, values in changed.items():
+            key = tuple(sorted(values.items()))
+            groups.setdefault(key, []).append(products[code].pk)
+
+        now = datetime.datetime.now()
+        for values, pks in groups.items():
+            values = dict(values, modified_at=now)
+            for chunk in chunks(pks, 900):
+                Product.objects.filter(pk__in=chunk).update(**values)
+
+        # Find the primary keys of all the products we have prices for
+        pks = dict(filter_in(Product.objects.values_list('code', 'pk'),
+            'code', list(codes)))
+
+        # Skip any prices that already exist
+        dates = set(date for code, date in prices.keys())
+        existing = set(filter_in(ProductPrice.objects.filter(
+            effective_date__in=dates).values_list('product', 'effective_date'),
+            'product', pks.values()))
+
+        new_prices = []
+        for (code, date), amount in prices.items():
+            if (pks[code], date) not in existing:
+                new_prices.append(ProductPrice(amount=str(amount),
+                    effective_date=date, product_id=pks[code]))
+
+        bulk_insert(ProductPrice, new_prices)
+
+        return (len(new_products), len(changed), len(new_prices))
+
+    def import_price_rows(self, rows):
         """
-        Import a list of price and product data from the given
-        sheet from an Excel workbook.
+        Import product and price data from the given rows of values.
+
+        In bulk mode the rows are streamed through a pipeline which reads,
+        normalizes and validates each row before writing them in chunks,
+        each within its own transaction, so that memory use does not grow
+        with the size of the file.
         """
-        keys = ['code', 'status', 'title', 'size', 'age', 'proof', 'per_case',
-                'price', 'price_effective_date']
+        progress = self.progress
+        rows = progress.timed(self.normalize_rows(rows), 'parse')
 
-        count = 0
-        for n in range(sheet.nrows):
-            values = sheet.row_values(n)
+        if self.bulk:
+            created, updated, prices = 0, 0, 0
 
-            # Strip any leading or trailing whitespace from the row values
-            values = [str(s).strip() for s in values]
+            rows = progress.timed(self.validate_rows(rows), 'validate')
+            for chunk in chunks(rows, self.chunk_size):
+                with progress.phase('write'):
+                    counts = self.write_price_chunk(chunk)
 
-            # Map our keys to the row values
-            obj = dict(zip(keys, values))
+                created += counts[0]
+                updated += counts[1]
+                prices += counts[2]
 
-            # Import our product
-            try:
-                product, created = self.product_from_row(obj)
+            progress.count('created_products', created)
+            progress.count('updated_products', updated)
+            progress.count('created_prices', prices)
+
+            self.uprint("\nImported '%s' new products, updated '%s' products "
+                    "and imported '%s' new prices!" % (created, updated, prices))
 
-                if product:
-                    count += 1
-                    self.uprint("[%s]: %s" % (product.code, product.title))
-            except Product.MultipleObjectsReturned:
-                print "Product code '%s' returned multiple results!" % obj['code']
+            count = created + updated + prices
+        else:
+            count = 0
+            for obj in rows:
+                # Import our product
+                try:
+                    with progress.phase('write'):
+                        product, created = self.product_from_row(obj)
 
-        self.uprint("\nImported '%s' new product records and/or prices!" % count)
+                    if product:
+                        count += 1
+                except Product.MultipleObjectsReturned:
+                    progress.count('duplicate_codes')
+                    print "Product code '%s' returned multiple results!" % obj['code']
+
+            self.uprint("\nImported '%s' new product records and/or prices!" % count)
+
+        invalid = progress.counters.get('invalid_rows')
+        if invalid:
+            self.uprint("\nSkipped '%s' invalid rows." % invalid)
 
         if count < 1:
             self.uprint("\nDid you specify the correct import type?")
 
+    def import_csv_prices(self, csvreader):
+        """
+        Import a list of price and product data from the given CSV reader.
+        """
+        self.import_price_rows(csvreader)
+
+    def import_prices(self, sheet):
+        """
+        Import a list of price and product data from the given
+        sheet from an Excel workbook.
+        """
+        self.import_price_rows(sheet.row_values(n) for n in range(sheet.nrows))
+
     def import_stores(self, sheet):
         """
         Import a list of store data from the given sheet
         from an Excel workbook.
         """
-        # Get our geocoder
-        g = geocoders.Google()
+        progress = self.progress
+        rows = {}
+
+        with progress.phase('parse'):
+            for n in range(sheet.nrows):
+                values = sheet.row_values(n)
+                progress.advance()
+
+                store_key = values[0]
+                if isinstance(store_key, (int, long, float)):
+                    data = Store.values_from_row(values)
+                    rows[data['key']] = data
+
+        # Load every existing store with a single query
+        stores = dict((s.key, s) for s in
+                filter_in(Store.objects.all(), 'key', rows.keys()))
+
+        # Keep the geocoded address of any store that has not moved
+        unlocated = []
+        for key, data in rows.items():
+            store = stores.get(key)
+            if store and store.address_raw == data['address_raw']:
+                data['address'] = store.address
+                data['latitude'] = store.latitude
+                data['longitude'] = store.longitude
+            else:
+                data['latitude'] = data['longitude'] = Decimal(0)
 
-        for n in range(sheet.nrows):
-            values = sheet.row_values(n)
+            if not data['latitude'] and not data['longitude']:
+                unlocated.append(data)
 
-            store_key = values[0]
-            if isinstance(store_key, (int, long, float)):
-                # Create new store instance
-                store = Store.from_row(values)
+        if self.geocode and unlocated:
+            with progress.phase('geocode'):
+                self.geocode_stores(unlocated)
 
-                if self.geocode:
-                    try:
-                        # Geocode the store location
-                        address, pos = g.geocode(store.address_raw)
+        with progress.phase('write'):
+            created, updated, unchanged = self.write_stores(rows, stores)
 
-                        store.address = address.strip()
-                        store.latitude = pos[0]
-                        store.longitude = pos[1]
-                        store.save()
-                    except ValueError:
-                        print "Multiple addresses returned for store %s!" % store.key
+        progress.count('created_stores', created)
+        progress.count('updated_stores', updated)
 
-                    # Sleep to prevent hitting the geocoder rate limit
-                    time.sleep(.35)
+        self.uprint("\nImported '%s' new stores, updated '%s' stores and "
+                "skipped '%s' unchanged stores!" % (created, updated, unchanged))
 
-                # Some output
-                self.uprint(store)
+    def geocode_stores(self, rows):
+        """
+        Geocode the addresses of the given rows of store data. Addresses
+        which have been geocoded before are read from the geocode cache,
+        and only the new addresses are sent to the geocoder.
+        """
+        results = geocode_addresses([data['address_raw'] for data in rows],
+                qps=self.geocode_qps, workers=self.geocode_workers)
+
+        for data in rows:
+            result = results.get(data['address_raw'])
+
+            if result is None:
+                self.progress.count('geocode_failures')
+                print "Unable to geocode the address for store %s!" % data['key']
+                continue
+
+            data['address'] = result.address
+            data['latitude'] = result.latitude
+            data['longitude'] = result.longitude
+
+    @transaction.commit_on_success
+    def write_stores(self, rows, stores):
+        """
+        Write the given rows of store data in a single transaction,
+        inserting new stores in bulk and updating only the fields of
+        existing stores that have changed, also in bulk.
+
+        :param rows: A dict of store keys mapped to dicts of field values.
+        :param stores: A dict of store keys mapped to existing Stores.
+        :return: A tuple containing the number of created, updated and
+                 unchanged stores.
+        """
+        new_stores = []
+        changed = {}
+
+        for key, data in sorted(rows.items()):
+            store = stores.get(key)
+
+            if store is None:
+                new_stores.append(Store(**data))
+                continue
+
+            for name, value in data.items():
+                value = store._meta.get_field(name).to_python(value)
+                if getattr(store, name) != value:
+                    changed.setdefault(store.pk, {})[name] = value
+
+        bulk_insert(Store, new_stores)
+        bulk_update(Store, changed)
+
+        updated = len(changed)
+        return (len(new_stores), updated, len(rows) - len(new_stores) - updated)
 
     def handle(self, *args, **options):
         self.quiet = options.get('quiet', False)
         self.geocode = options.get('geocode', True)
+        self.geocode_qps = options.get('geocode_qps')
+        self.geocode_workers = options.get('geocode_workers')
+        self.bulk = options.get('bulk', False)
+        self.chunk_size = options.get('chunk_size') or None
         self.import_type = options.get('import_type')
 
+        # Report to the caller's progress, if any
+        self.progress = options.get('progress') or \
+                Progress(self.stdout, self.quiet)
+
         try:
             # Get our filename
             filename = args[0]
@@ -230,13 +541,39 @@ class Command(BaseCommand):
 
             if self.import_type.startswith('csv'):
                 with open(filename, 'rb') as csvfile:
+                    # Count the rows so that we can estimate the time left
+                    self.progress.total = sum(1 for line in csvfile)
+                    csvfile.seek(0)
+
                     import_method(csv.reader(csvfile))
             else:
                 # Import workbook
-                wb = xlrd.open_workbook(filename, on_demand=True)
+                with self.progress.phase('parse'):
+                    wb = xlrd.open_workbook(filename, on_demand=True)
+                    sheet = wb.sheet_by_index(0)
 
                 # Import the first sheet
-                import_method(wb.sheet_by_index(0))
+                self.progress.total = sheet.nrows
+                import_method(sheet)
+
+            with self.progress.phase('refresh'):
+                if self.import_type != 'stores':
+                    # Refresh the denormalized product prices
+                    Product.objects.update_prices()
+
+                    # Refresh the pools of random products
+                    Product.objects.clear_sample()
+
+                # Expire any cached pages
+                bump_generation()
+
+            self.progress.finish()
+
+            if self.import_type != 'stores':
+                # Warn if the cache would cull pages before the next import
+                warning = check_cache_size(Product.objects.count())
+                if warning:
+                    self.stderr.write("Warning: %s\n" % warning)
         except IndexError:
             raise CommandError("You must specify a filename!")
         except IOError, e:
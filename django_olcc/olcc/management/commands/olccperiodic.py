@@ -1,8 +1,10 @@
 import datetime
 
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError, transaction
-from olcc.models import Product, ProductPrice
+from django.db import transaction
+from olcc.caching import bump_generation
+from olcc.management.progress import Progress
+from olcc.models import PriceMover, Product
 from optparse import make_option
 
 class Command(BaseCommand):
@@ -10,9 +12,9 @@ class Command(BaseCommand):
     A command to be run periodically to calculate Product status
     from updated price data.
 
-    This script will iterate over all product records and toggle
-    the 'on_sale' property if the item's price has dropped since
-    the previous month.
+    This script will toggle the 'on_sale' property of all product
+    records if the item's price has dropped since the previous month,
+    and record the products whose prices have moved in each new month.
 
     This command will only execute on the first of the month. You can
     force it to execute on other days with the '--force' option."""
@@ -22,6 +24,10 @@ class Command(BaseCommand):
             default=False, help='Force the command to execute.'),
         make_option('--quiet', action='store_true', dest='quiet',
             default=False, help='Suppress all output except errors'),
+        make_option('--rebuild-movers', action='store_true',
+            dest='rebuild_movers', default=False,
+            help='Record the price movers of every month, not only the '
+                'latest months.'),
     )
 
     def uprint(self, msg):
@@ -36,41 +42,35 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         self.force = options.get('force', False)
         self.quiet = options.get('quiet', False)
+        self.rebuild_movers = options.get('rebuild_movers', False)
 
         # Get today's date
         today = datetime.date.today()
 
         if self.force or (today.day == 1):
-            # Get the first of this month
-            this_month = today.replace(day=1)
-
-            # Get the first of last month
-            try:
-                last_month = today.replace(month=today.month-1, day=1)
-            except ValueError:
-                if today.month == 1:
-                    last_month = today.replace(year=today.year-1, month=12, day=1)
-
-            # Update the on sale flag for all products
-            count = 0
-            for p in Product.objects.all().order_by('title'):
-                try:
-                    current_price = p.prices.get(effective_date=this_month)
-                    previous_price = p.prices.get(effective_date=last_month)
-
-                    if current_price.amount < previous_price.amount:
-                        p.on_sale = True
-
-                        self.uprint('[SALE]: %s' % p)
-                        count += 1
-                    else:
-                        p.on_sale = False
-
-                    # Persist our changes
-                    p.save()
-                except ProductPrice.DoesNotExist:
-                    pass
+            progress = Progress(self.stdout, self.quiet)
+
+            with progress.phase('periodic'):
+                # Refresh the denormalized product prices
+                Product.objects.update_prices(today)
+
+                # Update the on sale flag for all products
+                count = Product.objects.update_on_sale()
+
+                # Record the products whose prices have moved
+                movers = PriceMover.objects.update_movers(
+                        rebuild=self.rebuild_movers)
+
+                # Refresh the pools of random products
+                Product.objects.clear_sample()
+
+                # Expire any cached pages
+                bump_generation()
+
+            progress.count('on_sale', count)
+            progress.count('movers', movers)
 
             self.uprint('\n%s items have dropped in price!' % count)
+            progress.finish()
         else:
             self.uprint('\nToday is not the first of the month! Exiting ...')
@@ -0,0 +1,193 @@
+import datetime
+import threading
+import time
+
+from contextlib import contextmanager
+
+class Progress(object):
+    """
+    Track and report the progress of a long running command.
+
+    Rows are counted with `advance`, which reports the number of rows
+    processed, the rate and the estimated time remaining at most once
+    every `interval` seconds, so that writing output never dominates
+    the work being done.
+
+    Time is attributed to named phases. Phases may be nested, in which
+    case time spent in an inner phase is not also counted towards the
+    outer phase. This allows each stage of a pipeline of generators to
+    be timed with `timed`, even though their work is interleaved.
+    """
+    def __init__(self, stdout, quiet=False, interval=2.0, total=None):
+        self.stdout = stdout
+        self.quiet = quiet
+        self.interval = interval
+        self.total = total
+
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_report = self.start
+        self.rows = 0
+        self.phases = {}
+        self.order = []
+        self.counters = {}
+        self.stack = []
+
+    def write(self, msg):
+        """
+        Unbuffered print.
+        """
+        if not self.quiet:
+            self.stdout.write("%s\n" % msg)
+            self.stdout.flush()
+
+    def add_time(self, name, seconds):
+        """
+        Add the given number of seconds to the named phase.
+        """
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = 0.0
+                self.order.append(name)
+            self.phases[name] += seconds
+
+    def enter(self, name):
+        """
+        Start timing the named phase, pausing the current phase.
+        """
+        now = time.time()
+        if self.stack:
+            # Pause the outer phase
+            outer, start = self.stack[-1]
+            self.add_time(outer, now - start)
+        self.stack.append((name, now))
+
+    def exit(self):
+        """
+        Stop timing the current phase, resuming the phase it interrupted.
+        """
+        now = time.time()
+        name, start = self.stack.pop()
+        self.add_time(name, now - start)
+        if self.stack:
+            # Resume the outer phase
+            self.stack[-1] = (self.stack[-1][0], now)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as part of the named phase.
+        """
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def timed(self, iterable, name):
+        """
+        Yield the items of the given iterable, timing the work done to
+        produce each of them as part of the named phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def count(self, name, n=1):
+        """
+        Increment the named counter, such as a count of errors.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def advance(self, rows=1):
+        """
+        Count the given number of processed rows, reporting progress if
+        enough time has passed since the last report.
+        """
+        self.rows += rows
+
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed else 0.0
+
+    @property
+    def eta(self):
+        """
+        The estimated number of seconds remaining, or None if unknown.
+        """
+        if not self.total or not self.rate:
+            return None
+        return max(0, self.total - self.rows) / self.rate
+
+    def report(self):
+        """
+        Write a line describing the progress so far.
+        """
+        if self.total:
+            msg = "%s / %s rows (%d%%)" % (self.rows, self.total,
+                    100 * self.rows // self.total)
+        else:
+            msg = "%s rows" % self.rows
+
+        msg += ", %.0f rows/sec" % self.rate
+
+        eta = self.eta
+        if eta is not None:
+            msg += ", ETA %s" % datetime.timedelta(seconds=int(eta))
+
+        self.write(msg)
+
+    def summary(self):
+        """
+        Return a dict summarizing the rows processed, the time taken by
+        each phase and the counters, suitable for serializing as JSON.
+        """
+        elapsed = self.elapsed
+        return {
+            'rows': self.rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(self.rows / elapsed, 1) if elapsed else None,
+            'phases': dict((name, round(self.phases[name], 3)) for
+                name in self.order),
+            'counters': dict(self.counters),
+        }
+
+    def finish(self):
+        """
+        Write a line describing the time taken by each phase and the
+        value of each counter.
+        """
+        summary = self.summary()
+
+        msg = "Finished in %.2f seconds" % summary['seconds']
+        if self.rows:
+            msg = "Finished %s rows in %.2f seconds" % (self.rows,
+                    summary['seconds'])
+        if self.order:
+            msg += " (%s)" % ', '.join("%s %.2fs" % (name, self.phases[name])
+                    for name in self.order)
+        self.write(msg)
+
+        if self.counters:
+            self.write(', '.join("%s: %s" % item for item in
+                sorted(self.counters.items())))
+
+        return summary
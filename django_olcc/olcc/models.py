@@ -1,11 +1,19 @@
 import datetime
+import random
 import re
 
-from django.db import models, IntegrityError
+from itertools import islice
+
+from django.core.cache import cache
+from django.db import connection, models, transaction, IntegrityError
 from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.db.models.query import QuerySet, ITER_CHUNK_SIZE
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 
+from olcc.caching import clear_last_updated
+
 def format_phone(phone):
     """
     Sanitize an input string and format the result as a
@@ -14,6 +22,17 @@ def format_phone(phone):
     phone = re.sub(r'[^0-9]', '', phone)
     return "(%s) %s-%s" % (phone[:3], phone[3:6], phone[6:])
 
+# How long to cache the pools of product ids sampled by ProductManager.sample
+SAMPLE_POOL_TIMEOUT = 60 * 60 * 24
+
+def add_months(date, months):
+    """
+    Return the first day of the month that is the given number of
+    months before or after the given date.
+    """
+    month = date.month - 1 + months
+    return datetime.date(date.year + month // 12, month % 12 + 1, 1)
+
 class ImportRecord(models.Model):
     """
     This model represents a product import.
@@ -23,19 +42,170 @@ class ImportRecord(models.Model):
             help_text="The value of the ETag header returned from the server.")
     local_checksum = models.CharField(max_length=32,
             help_text="The local md5 hexdigest of the file.")
+    last_modified = models.CharField(max_length=64, blank=True, default='',
+            help_text="The value of the Last-Modified header returned from "
+                "the server.")
+    summary = models.TextField(blank=True, default='',
+            help_text="A JSON summary of the rows, timings and errors "
+                "of the import.")
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     modified_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         get_latest_by = 'created_at'
 
+class ProductQuerySet(QuerySet):
+    """
+    A QuerySet that can attach a window of monthly prices to each of the
+    products it returns, see `ProductManager.with_prices`.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ProductQuerySet, self).__init__(*args, **kwargs)
+        self._price_months = ()
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        if klass is None or issubclass(klass, ProductQuerySet):
+            kwargs.setdefault('_price_months', self._price_months)
+        return super(ProductQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def with_prices(self, month=None):
+        """
+        Load the prices for the month before, the month of and the month
+        after the given date with a single extra query per chunk of
+        products, and attach them to each product.
+        """
+        month = (month or datetime.date.today()).replace(day=1)
+        months = (add_months(month, -1), month, add_months(month, 1))
+        return self._clone(_price_months=months)
+
+    def iterator(self):
+        objects = super(ProductQuerySet, self).iterator()
+
+        if not self._price_months:
+            for obj in objects:
+                yield obj
+            return
+
+        while True:
+            chunk = list(islice(objects, ITER_CHUNK_SIZE))
+            if not chunk:
+                return
+
+            prices = dict((obj.pk, {}) for obj in chunk)
+            for price in ProductPrice.objects.filter(
+                    product__in=prices.keys(),
+                    effective_date__in=self._price_months):
+                prices[price.product_id][price.effective_date] = price
+
+            for obj in chunk:
+                obj._price_months = self._price_months
+                obj._prices = prices[obj.pk]
+                yield obj
+
 class ProductManager(models.Manager):
+    def get_query_set(self):
+        return ProductQuerySet(self.model, using=self._db)
+
+    def with_prices(self, month=None):
+        """
+        Return products with their prices around the given month
+        attached, see `ProductQuerySet.with_prices`.
+        """
+        return self.get_query_set().with_prices(month)
+
     def on_sale(self):
         """
         Find all products that have dropped in price since last month.
         """
         return self.get_query_set().filter(on_sale=True)
 
+    def sample(self, count, on_sale=False, exclude=()):
+        """
+        Return a list of up to `count` random products.
+
+        The ids of all products, or of all products on sale, are cached
+        and sampled in Python so that picking random products does not
+        require sorting the product table.
+
+        :param exclude: Primary keys of products which should not be picked.
+        """
+        key = 'olcc:sample:%s' % ('on_sale' if on_sale else 'all',)
+        pks = cache.get(key)
+
+        if pks is None:
+            products = self.on_sale() if on_sale else self.get_query_set()
+            pks = list(products.values_list('pk', flat=True))
+            cache.set(key, pks, SAMPLE_POOL_TIMEOUT)
+
+        exclude = set(exclude)
+        picked = random.sample(pks, min(len(pks), count + len(exclude)))
+        picked = [pk for pk in picked if pk not in exclude][:count]
+
+        products = self.in_bulk(picked)
+        return [products[pk] for pk in picked if pk in products]
+
+    def clear_sample(self):
+        """
+        Clear the cached pools of product ids used by `sample`.
+        """
+        cache.delete_many(['olcc:sample:all', 'olcc:sample:on_sale'])
+
+    def update_prices(self, today=None):
+        """
+        Copy last month's, this month's and next month's price for every
+        product into the denormalized price columns on the product table
+        and calculate the change in price since last month.
+        """
+        today = today or datetime.date.today()
+        this_month = today.replace(day=1)
+
+        qn = connection.ops.quote_name
+        product_table = qn(self.model._meta.db_table)
+        price_table = qn(ProductPrice._meta.db_table)
+
+        price = "(SELECT %(amount)s FROM %(price_table)s WHERE " \
+                "%(price_table)s.%(product)s = %(product_table)s.%(pk)s " \
+                "AND %(price_table)s.%(date)s = %%s)" % {
+                    'amount': qn('amount'),
+                    'date': qn('effective_date'),
+                    'pk': qn(self.model._meta.pk.column),
+                    'product': qn(ProductPrice._meta.get_field('product').column),
+                    'product_table': product_table,
+                    'price_table': price_table,
+                }
+
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET %s = %s, %s = %s, %s = %s" % (
+            product_table,
+            qn('previous_price'), price,
+            qn('current_price'), price,
+            qn('next_price'), price,
+        ), [add_months(this_month, -1), this_month, add_months(this_month, 1)])
+
+        cursor.execute("UPDATE %s SET %s = ROUND(%s - %s, 2)" % (
+            product_table, qn('price_change'), qn('current_price'),
+            qn('previous_price')))
+
+        transaction.commit_unless_managed()
+
+    def update_on_sale(self):
+        """
+        Toggle the 'on_sale' flag for every product with both a current
+        and a previous price, depending on whether the price has dropped
+        since last month. The denormalized prices should be refreshed
+        with `update_prices` first.
+
+        :return: The number of products that are now on sale.
+        """
+        priced = self.get_query_set().filter(current_price__isnull=False,
+                previous_price__isnull=False)
+
+        priced.filter(current_price__gte=F('previous_price'))\
+                .update(on_sale=False)
+
+        return priced.filter(current_price__lt=F('previous_price'))\
+                .update(on_sale=True)
+
 class Product(models.Model):
     """
     This model represents a product.
@@ -59,6 +229,17 @@ class Product(models.Model):
     age = models.DecimalField(blank=True, max_digits=5, decimal_places=2,
             default=0, help_text="Age in years",)
 
+    # Denormalized prices, see ProductManager.update_prices()
+    current_price = models.DecimalField(blank=True, null=True, max_digits=9,
+            decimal_places=2, db_index=True, help_text="This month's price",)
+    previous_price = models.DecimalField(blank=True, null=True, max_digits=9,
+            decimal_places=2, help_text="Last month's price",)
+    next_price = models.DecimalField(blank=True, null=True, max_digits=9,
+            decimal_places=2, help_text="Next month's price",)
+    price_change = models.DecimalField(blank=True, null=True, max_digits=9,
+            decimal_places=2, db_index=True,
+            help_text="The change in price since last month",)
+
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     modified_at = models.DateTimeField(auto_now=True, db_index=True)
 
@@ -87,44 +268,26 @@ class Product(models.Model):
     @property
     def price(self):
         """
-        Return the current price for this Product.
+        Return the current ProductPrice for this Product.
         """
-        today = datetime.date.today()
-        this_month = today.replace(day=1)
-
-        return self.prices.get(effective_date=this_month)
+        return self.price_for(datetime.date.today())
 
-    @property
-    def previous_price(self):
+    def price_for(self, date):
         """
-        Return last month's price for this Product.
+        Return the ProductPrice effective for the month of the given date,
+        or None if there is no price for that month. Prices attached by
+        `ProductManager.with_prices` are used instead of a query when
+        they cover the month.
         """
-        today = datetime.date.today()
-
-        # Get the first of last month
-        try:
-            last_month = today.replace(month=today.month-1, day=1)
-        except ValueError:
-            if today.month == 1:
-                last_month = today.replace(year=today.year-1, month=12, day=1)
-
-        return self.prices.get(effective_date=last_month)
+        month = date.replace(day=1)
 
-    @property
-    def next_price(self):
-        """
-        Return last month's price for this Product.
-        """
-        today = datetime.date.today()
+        if month in getattr(self, '_price_months', ()):
+            return self._prices.get(month)
 
-        # Get the first of next month
         try:
-            next_month = today.replace(month=today.month+1, day=1)
-        except ValueError:
-            if today.month == 12:
-                next_month = today.replace(year=today.year+1, month=1, day=1)
-
-        return self.prices.get(effective_date=next_month)
+            return self.prices.get(effective_date=month)
+        except ProductPrice.DoesNotExist:
+            return None
 
     @classmethod
     def format_title(cls, title):
@@ -169,6 +332,118 @@ class ProductPrice(models.Model):
     def __unicode__(self):
         return u'$%.2f' % (self.amount,)
 
+# The orderings of PriceMoverManager.top, as the field to order by and
+# the filter selecting either the drops or the increases.
+MOVER_SORTS = {
+    'drop': ('delta', {'delta__lt': 0}),
+    'percent_drop': ('percent_delta', {'percent_delta__lt': 0}),
+    'increase': ('-delta', {'delta__gt': 0}),
+    'percent_increase': ('-percent_delta', {'percent_delta__gt': 0}),
+}
+
+class PriceMoverManager(models.Manager):
+    def update_movers(self, since=None, rebuild=False):
+        """
+        Record the change in price of every product whose price changed
+        from one month to the next, for each month from the given month
+        onwards. By default only the months from the latest month already
+        recorded are updated, unless `rebuild` is set, for example after
+        importing an older price history.
+
+        Prices are never changed once imported, so each month is updated
+        with a single query which inserts the movers not yet recorded.
+
+        :return: The number of movers recorded.
+        """
+        if since is None and not rebuild:
+            try:
+                since = self.get_query_set().latest().month
+            except self.model.DoesNotExist:
+                pass
+
+        prices = ProductPrice.objects.all()
+        if since is not None:
+            prices = prices.filter(effective_date__gte=since)
+
+        qn = connection.ops.quote_name
+        params = {
+            'mover_table': qn(self.model._meta.db_table),
+            'price_table': qn(ProductPrice._meta.db_table),
+            'product': qn(ProductPrice._meta.get_field('product').column),
+            'amount': qn('amount'),
+            'date': qn('effective_date'),
+            'month': qn('month'),
+        }
+
+        sql = "INSERT INTO %(mover_table)s (%(product)s, %(month)s, " \
+                "%(previous_amount)s, %(amount)s, %(delta)s, " \
+                "%(percent_delta)s, %(created_at)s) " \
+                "SELECT p.%(product)s, p.%(date)s, q.%(amount)s, " \
+                "p.%(amount)s, ROUND(p.%(amount)s - q.%(amount)s, 2), " \
+                "CASE WHEN q.%(amount)s > 0 THEN ROUND((p.%(amount)s - " \
+                "q.%(amount)s) * 100.0 / q.%(amount)s, 2) END, %%s " \
+                "FROM %(price_table)s p INNER JOIN %(price_table)s q " \
+                "ON q.%(product)s = p.%(product)s AND q.%(date)s = %%s " \
+                "WHERE p.%(date)s = %%s AND p.%(amount)s <> q.%(amount)s " \
+                "AND NOT EXISTS (SELECT 1 FROM %(mover_table)s m WHERE " \
+                "m.%(product)s = p.%(product)s AND m.%(month)s = " \
+                "p.%(date)s)" % dict(params,
+                    previous_amount=qn('previous_amount'),
+                    delta=qn('delta'),
+                    percent_delta=qn('percent_delta'),
+                    created_at=qn('created_at'))
+
+        now = datetime.datetime.now()
+        count = 0
+
+        cursor = connection.cursor()
+        for month in prices.dates('effective_date', 'month'):
+            month = month.date()
+            cursor.execute(sql, [now, add_months(month, -1), month])
+            count += max(cursor.rowcount, 0)
+
+        transaction.commit_unless_managed()
+
+        return count
+
+    def top(self, month, sort='drop'):
+        """
+        Return the movers for the given month with the biggest drops or
+        increases in price first.
+
+        :param sort: One of the keys of MOVER_SORTS.
+        """
+        order_by, filters = MOVER_SORTS[sort]
+        return self.get_query_set().filter(month=month.replace(day=1),
+                **filters).order_by(order_by, 'pk')
+
+class PriceMover(models.Model):
+    """
+    This model represents the change in a product's price since the
+    previous month, materialized by `PriceMoverManager.update_movers`.
+    """
+    product = models.ForeignKey(Product, related_name='movers')
+    month = models.DateField(db_index=True,)
+    previous_amount = models.DecimalField(max_digits=9, decimal_places=2,)
+    amount = models.DecimalField(max_digits=9, decimal_places=2,)
+    delta = models.DecimalField(max_digits=9, decimal_places=2,
+            help_text="The change in price since the previous month",)
+    percent_delta = models.DecimalField(max_digits=9, decimal_places=2,
+            null=True, blank=True,
+            help_text="The percent change in price since the previous month",)
+    created_at = models.DateTimeField(auto_now_add=True,)
+
+    objects = PriceMoverManager()
+
+    class Meta:
+        unique_together = ("product", "month")
+        ordering = ['-month', 'delta',]
+        get_latest_by = 'month'
+
+    def __unicode__(self):
+        return u'%s: $%.2f to $%.2f' % (self.month, self.previous_amount,
+                self.amount,)
+
 class Store(models.Model):
     """
     This model represents the physical location of an
@@ -204,29 +479,36 @@ class Store(models.Model):
         return [h.strip() for h in self.hours_raw.split(';')]
 
     @classmethod
-    def from_row(cls, values):
+    def values_from_row(cls, values):
         """
-        Create a new Store object from a row of OLCC store data.
+        Return a dict of Store field values from a row of OLCC store data.
         """
         # key, name, phone, address, hours, county
-        store = None
-        store_key = values[0]
-        if store_key:
-            try:
-                # Update an existing store record
-                store = Store.objects.get(key=store_key)
-            except Store.DoesNotExist, IntegrityError:
-                # Create new store
-                store = Store()
-                store.key = int(store_key)
-
-            # Update model
-            store.name = "%s Liquor" % values[1].strip()
-            store.phone = format_phone(values[2].strip())
-            store.address = values[3].strip()
-            store.address_raw = store.address
-            store.hours_raw = values[4].strip()
-            store.county = values[5].strip()
-            store.save()
-
-        return store
+        address = values[3].strip()
+        return {
+            'key': int(values[0]),
+            'name': "%s Liquor" % values[1].strip(),
+            'phone': format_phone(values[2].strip()),
+            'address': address,
+            'address_raw': address,
+            'hours_raw': values[4].strip(),
+            'county': values[5].strip(),
+        }
+
+class GeocodedAddress(models.Model):
+    """
+    This model caches the result of geocoding a raw store address.
+    """
+    key = models.CharField(unique=True, max_length=200,
+            help_text="The normalized raw address.")
+    address = models.CharField(max_length=200,)
+    latitude = models.DecimalField(max_digits=9, decimal_places=6,)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6,)
+    created_at = models.DateTimeField(auto_now_add=True,)
+
+    def __unicode__(self):
+        return u'%s (%s, %s)' % (self.address, self.latitude, self.longitude,)
+
+# Invalidate the cached date of the latest import
+post_save.connect(clear_last_updated, sender=ImportRecord)
+post_delete.connect(clear_last_updated, sender=ImportRecord)
@@ -0,0 +1,211 @@
+import base64
+import hashlib
+import json
+import urllib
+
+from django.core.cache import cache
+from django.db.models import Q
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+from olcc.caching import CACHE_TIMEOUT, generation
+
+def encode_cursor(direction, values=()):
+    """
+    Return an opaque cursor token for the given direction, either
+    'after' or 'before', and the ordering values of a row.
+    """
+    data = json.dumps([direction == 'before'] + list(values))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def decode_cursor(token):
+    """
+    Return a tuple of the direction and ordering values of a cursor token.
+
+    :raises ValueError: If the token is invalid.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            str(token) + '=' * (-len(token) % 4)))
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError("Invalid cursor: %s" % token)
+
+    if not isinstance(data, list) or not data or not all(
+            isinstance(v, (basestring, int, long, float)) for v in data):
+        raise ValueError("Invalid cursor: %s" % token)
+
+    return ('before' if data[0] else 'after', tuple(data[1:]))
+
+def cached_count(queryset):
+    """
+    Return the number of rows in the given queryset, counting them only
+    once per cache generation.
+    """
+    key = 'olcc:count:%s:%s' % (generation(),
+            hashlib.md5(unicode(queryset.query).encode('utf-8')).hexdigest())
+
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, CACHE_TIMEOUT)
+    return count
+
+class KeysetPage(object):
+    """
+    A page of results from a KeysetPaginator.
+    """
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return self.paginator.cursor('after', self.object_list[-1])
+
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return self.paginator.cursor('before', self.object_list[0])
+
+    def last_cursor(self):
+        return encode_cursor('before')
+
+class KeysetPaginator(object):
+    """
+    Paginate a queryset by the values of its ordering keys rather
+    than by offset, so that every page costs the same to load no
+    matter how deep it is.
+
+    Pages are addressed by opaque cursor tokens which hold the keys of
+    the row the page starts after or ends before. The keys must
+    uniquely order the queryset, so the last key should be the
+    primary key.
+    """
+    def __init__(self, object_list, per_page, keys=('title', 'pk')):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.keys = keys
+
+    @property
+    def count(self):
+        return cached_count(self.object_list)
+
+    def cursor(self, direction, obj):
+        """
+        Return the cursor token for the page after or before the given row.
+        """
+        return encode_cursor(direction, [getattr(obj, k) for k in self.keys])
+
+    def seek(self, direction, values):
+        """
+        Return a filter matching the rows after or before the given keys.
+        """
+        lookup = 'lt' if direction == 'before' else 'gt'
+
+        q = Q()
+        for i in reversed(range(len(self.keys))):
+            key = Q(**{'%s__%s' % (self.keys[i], lookup): values[i]})
+            q = key | (Q(**{self.keys[i]: values[i]}) & q) if q else key
+        return q
+
+    def page(self, token=None):
+        """
+        Return the page of results for the given cursor token, or the
+        first page if no token is given.
+
+        :raises ValueError: If the token is invalid.
+        """
+        direction, values = decode_cursor(token) if token else ('after', ())
+        if values and len(values) != len(self.keys):
+            raise ValueError("Invalid cursor: %s" % token)
+
+        objects = self.object_list
+        if values:
+            objects = objects.filter(self.seek(direction, values))
+
+        if direction == 'before':
+            objects = objects.order_by(*['-%s' % k for k in self.keys])
+        else:
+            objects = objects.order_by(*self.keys)
+
+        # Fetch an extra row to find out if there are any more pages
+        objects = list(objects[:self.per_page + 1])
+        more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+
+        if direction == 'before':
+            objects.reverse()
+            return KeysetPage(objects, self, bool(values), more)
+        return KeysetPage(objects, self, more, bool(values))
+
+class CachedCountPaginator(Paginator):
+    """
+    A tastypie paginator which counts the results once per cache generation.
+    """
+    def get_count(self):
+        if hasattr(self.objects, 'query'):
+            return cached_count(self.objects)
+        return super(CachedCountPaginator, self).get_count()
+
+class KeysetApiPaginator(CachedCountPaginator):
+    """
+    A tastypie paginator using keyset pagination, with `cursor` tokens
+    in place of offsets.
+
+    Requests using `offset` or `order_by` are paginated by offset as before.
+    """
+    keys = ('title', 'pk')
+
+    def use_keyset(self):
+        return 'offset' not in self.request_data and \
+                'order_by' not in self.request_data and \
+                hasattr(self.objects, 'filter')
+
+    def _generate_cursor_uri(self, limit, token):
+        if self.resource_uri is None or token is None:
+            return None
+
+        request_params = dict([k, v.encode('utf-8')] for k, v in
+                self.request_data.items())
+        request_params.update({'limit': limit, 'cursor': token})
+        return '%s?%s' % (self.resource_uri, urllib.urlencode(request_params))
+
+    def page(self):
+        if not self.use_keyset():
+            return super(KeysetApiPaginator, self).page()
+
+        limit = self.get_limit()
+        count = self.get_count()
+
+        paginator = KeysetPaginator(self.objects, limit or count or 1, self.keys)
+        try:
+            page = paginator.page(self.request_data.get('cursor'))
+        except ValueError, e:
+            raise BadRequest(str(e))
+
+        return {
+            'objects': page.object_list,
+            'meta': {
+                'limit': limit,
+                'total_count': count,
+                'previous': self._generate_cursor_uri(limit,
+                    page.previous_cursor()),
+                'next': self._generate_cursor_uri(limit, page.next_cursor()),
+            },
+        }
@@ -0,0 +1,188 @@
+import bisect
+import re
+import threading
+
+from django.db import connection
+from django.db.models import Max
+
+from olcc.models import Product
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """
+    Split the given text into a list of lowercase word tokens.
+    """
+    return TOKEN_RE.findall(text.lower())
+
+def escape_like(text):
+    """
+    Escape the wildcards of a LIKE pattern, so that the text is only
+    matched literally.
+    """
+    return re.sub(r'([\\%_])', r'\\\1', text)
+
+class PostgresSearch(object):
+    """
+    Search product titles using the full-text and trigram indexes
+    created by 'sql/product.postgresql_psycopg2.sql'.
+
+    syncdb only runs that file when it creates the product table, so an
+    existing database needs it run by hand, for example with:
+
+        $ psql <database> -f olcc/sql/product.postgresql_psycopg2.sql
+
+    Until the pg_trgm extension is installed, results are ranked by
+    ts_rank alone instead of failing.
+    """
+    # Whether the pg_trgm extension is installed, checked once per process
+    has_trigram = None
+
+    def trigram_installed(self):
+        if PostgresSearch.has_trigram is None:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            PostgresSearch.has_trigram = cursor.fetchone() is not None
+        return PostgresSearch.has_trigram
+
+    def queryset(self, query, products):
+        """
+        Return the given products matching the query, with their rank.
+        """
+        vector = "to_tsvector('english', olcc_product.title)"
+        tsquery = "plainto_tsquery('english', %s)"
+
+        rank = "ts_rank(%s, %s)" % (vector, tsquery)
+        rank_params = [query]
+        if self.trigram_installed():
+            rank += " + similarity(olcc_product.title, %s)"
+            rank_params.append(query)
+
+        return products.extra(
+            select={'rank': rank},
+            select_params=rank_params,
+            where=["%s @@ %s OR olcc_product.title ILIKE %%s "
+                   "OR UPPER(olcc_product.code) = UPPER(%%s)" % (vector, tsquery)],
+            params=[query, '%%%s%%' % escape_like(query), query],
+            order_by=['-rank', 'title'])
+
+    def search(self, query, products):
+        products = self.queryset(query, products)
+        return [pk for pk, rank in products.values_list('pk', 'rank')]
+
+class InvertedIndex(object):
+    """
+    An in-process inverted index of product titles, used where the
+    database has no full-text search support.
+
+    The index is refreshed incrementally before each search with any
+    products modified since it was last refreshed.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.titles = {}
+        self.postings = {}
+        self.tokens = []
+        self.modified_at = None
+
+    def add(self, pk, title):
+        """
+        Add or replace a product title in the index.
+        """
+        for token in self.titles.get(pk, ()):
+            self.postings[token].discard(pk)
+
+        tokens = tokenize(title)
+        self.titles[pk] = tokens
+
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(pk)
+
+    def refresh(self):
+        """
+        Index any products modified since the last refresh.
+        """
+        latest = Product.objects.aggregate(Max('modified_at'))['modified_at__max']
+
+        with self.lock:
+            if latest == self.modified_at:
+                return
+
+            products = Product.objects.all()
+            if self.modified_at:
+                products = products.filter(modified_at__gte=self.modified_at)
+
+            for pk, title in products.values_list('pk', 'title'):
+                self.add(pk, title)
+
+            self.tokens = sorted(self.postings.keys())
+            self.modified_at = latest
+
+    def matches(self, token):
+        """
+        Return a dict of product ids mapped to a score for all products
+        with a title containing a word starting with the given token.
+        Whole word matches score higher than prefix matches.
+        """
+        scores = {}
+
+        i = bisect.bisect_left(self.tokens, token)
+        while i < len(self.tokens) and self.tokens[i].startswith(token):
+            score = 2 if self.tokens[i] == token else 1
+            for pk in self.postings[self.tokens[i]]:
+                scores[pk] = max(scores.get(pk, 0), score)
+            i += 1
+
+        return scores
+
+    def search(self, query, products):
+        self.refresh()
+
+        # Restrict the results to the given products
+        allowed = None
+        if products.query.where:
+            allowed = set(products.values_list('pk', flat=True))
+
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        # Every token in the query must match
+        scores = None
+        for token in tokens:
+            matches = self.matches(token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((pk, score + matches[pk])
+                        for pk, score in scores.items() if pk in matches)
+
+        if allowed is not None:
+            scores = dict((pk, score) for pk, score in scores.items()
+                    if pk in allowed)
+
+        # Favor products with shorter titles
+        ranked = sorted(scores, key=lambda pk: (
+            -float(scores[pk]) / len(self.titles[pk]), self.titles[pk]))
+
+        # Exact product code matches come first
+        code = list(products.filter(code__iexact=query)\
+                .values_list('pk', flat=True))
+
+        return code + [pk for pk in ranked if pk not in code]
+
+# The in-process index is shared by all requests
+index = InvertedIndex()
+
+def search(query, products=None):
+    """
+    Search the given product queryset for the given query.
+
+    :return: A list of product ids ordered by relevance.
+    """
+    if products is None:
+        products = Product.objects.all()
+
+    if connection.vendor == 'postgresql':
+        return PostgresSearch().search(query, products)
+    return index.search(query, products)
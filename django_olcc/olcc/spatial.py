@@ -0,0 +1,180 @@
+import heapq
+import math
+import threading
+
+from olcc.caching import generation
+from olcc.models import Store
+
+# The mean radius of the earth in miles
+EARTH_RADIUS = 3958.8
+
+# The default and maximum number of stores returned by a lookup
+NEAREST_COUNT = 5
+MAX_NEAREST_COUNT = 50
+
+def to_vector(lat, lng):
+    """
+    Return the point on the unit sphere for the given coordinates.
+    """
+    lat, lng = math.radians(float(lat)), math.radians(float(lng))
+    return (math.cos(lat) * math.cos(lng),
+            math.cos(lat) * math.sin(lng),
+            math.sin(lat))
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Return the great circle distance in miles between two points.
+    """
+    lat1, lng1, lat2, lng2 = [math.radians(float(v)) for v in
+            (lat1, lng1, lat2, lng2)]
+
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+            math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+class KDTree(object):
+    """
+    A static k-d tree of points on the unit sphere.
+
+    The straight line distance between two points on the sphere grows
+    with the great circle distance between them, so the nearest points
+    in three dimensions are also the nearest points on the earth, without
+    any special handling for the poles or the antimeridian.
+    """
+    def __init__(self, points):
+        """
+        :param points: A list of (vector, item) tuples.
+        """
+        self.size = len(points)
+        self.root = self.build(list(points), 0)
+
+    def build(self, points, depth):
+        if not points:
+            return None
+
+        axis = depth % 3
+        points.sort(key=lambda p: p[0][axis])
+        median = len(points) // 2
+
+        return (points[median], axis,
+                self.build(points[:median], depth + 1),
+                self.build(points[median + 1:], depth + 1))
+
+    def nearest(self, vector, k):
+        """
+        Return a list of the `k` items nearest the given vector as
+        (squared distance, item) tuples, nearest first.
+        """
+        # A max-heap of the best candidates so far
+        heap = []
+
+        def visit(node):
+            if node is None:
+                return
+
+            (point, item), axis, left, right = node
+
+            d = sum((a - b) ** 2 for a, b in zip(point, vector))
+            if len(heap) < k:
+                heapq.heappush(heap, (-d, item))
+            elif d < -heap[0][0]:
+                heapq.heapreplace(heap, (-d, item))
+
+            diff = vector[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+
+            visit(near)
+
+            # Only search the far side if it could hold a closer point
+            if len(heap) < k or diff ** 2 < -heap[0][0]:
+                visit(far)
+
+        if k > 0:
+            visit(self.root)
+
+        return sorted((-d, item) for d, item in heap)
+
+class StoreIndex(object):
+    """
+    An in-process spatial index of store locations.
+
+    The index is rebuilt whenever the cache generation changes, which
+    happens after every import.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = (KDTree([]), {})
+        self.generation = None
+
+    def refresh(self):
+        """
+        Rebuild the index if any data has been imported since it was built.
+        """
+        current = generation()
+
+        with self.lock:
+            if current == self.generation:
+                return
+
+            # Skip any stores which have not been geocoded
+            stores = Store.objects.exclude(latitude=0, longitude=0)\
+                    .values_list('pk', 'latitude', 'longitude')
+
+            locations = dict((pk, (lat, lng)) for pk, lat, lng in stores)
+            tree = KDTree([(to_vector(lat, lng), pk) for pk, (lat, lng)
+                in locations.items()])
+
+            # Replace the tree and locations together
+            self.data = (tree, locations)
+            self.generation = current
+
+    def nearest(self, lat, lng, k):
+        """
+        Return a list of the ids of the `k` stores nearest the given
+        coordinates as (store id, distance in miles) tuples.
+        """
+        self.refresh()
+
+        tree, locations = self.data
+        return [(pk, haversine(lat, lng, *locations[pk])) for d, pk in
+                tree.nearest(to_vector(lat, lng), k)]
+
+# The in-process index is shared by all requests
+index = StoreIndex()
+
+def parse_location(params):
+    """
+    Return a tuple of the latitude, longitude and number of stores
+    to find from the given request parameters.
+
+    :raises ValueError: If the parameters are missing or invalid.
+    """
+    try:
+        lat, lng = float(params['lat']), float(params['lng'])
+        k = int(params.get('k', NEAREST_COUNT))
+    except KeyError, e:
+        raise ValueError("Missing parameter: %s" % e)
+
+    if not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        raise ValueError("Invalid coordinates: %s, %s" % (lat, lng))
+    if k < 1:
+        raise ValueError("Invalid number of stores: %s" % k)
+
+    return (lat, lng, min(k, MAX_NEAREST_COUNT))
+
+def nearest_stores(lat, lng, k=NEAREST_COUNT):
+    """
+    Return a list of the `k` stores nearest the given coordinates,
+    nearest first. Each store has its distance in miles set as the
+    `distance` attribute.
+    """
+    nearest = index.nearest(lat, lng, k)
+    stores = Store.objects.in_bulk([pk for pk, distance in nearest])
+
+    results = []
+    for pk, distance in nearest:
+        if pk in stores:
+            stores[pk].distance = distance
+            results.append(stores[pk])
+
+    return results
@@ -0,0 +1,4 @@
+-- Top movers of a month by PriceMoverManager.top, in either direction
+CREATE INDEX olcc_pricemover_delta ON olcc_pricemover (month, delta);
+CREATE INDEX olcc_pricemover_percent_delta ON olcc_pricemover
+    (month, percent_delta);
@@ -0,0 +1,6 @@
+-- Full-text and trigram indexes used by olcc.search.PostgresSearch
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX olcc_product_title_fts ON olcc_product
+    USING gin (to_tsvector('english', title));
+CREATE INDEX olcc_product_title_trgm ON olcc_product
+    USING gin (title gin_trgm_ops);
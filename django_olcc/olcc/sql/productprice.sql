@@ -0,0 +1,3 @@
+-- Covers the price history queries made by olcc.history.price_history
+CREATE INDEX olcc_productprice_history ON olcc_productprice
+    (product_id, effective_date, amount);
@@ -1,9 +1,16 @@
-from django import template
+import re
 
-from bs4 import BeautifulSoup
+from django import template
 
 register = template.Library()
 
+# Matches the start tag of an anchor element
+ANCHOR_RE = re.compile(r'<a\b[^>]*>', re.IGNORECASE)
+
+# Matches the href and class attributes of an anchor start tag
+HREF_RE = re.compile(r'''\shref\s*=\s*(?:"([^"]*)"|'([^']*)')''', re.IGNORECASE)
+CLASS_RE = re.compile(r'''\sclass\s*=\s*(?:"[^"]*"|'[^']*')''', re.IGNORECASE)
+
 @register.tag(name='activehref')
 def do_active_href(parser, token):
     nodelist = parser.parse(('endactivehref',))
@@ -23,26 +30,65 @@ class ActiveHref(template.Node):
     <li><a href="{% url stores %}">Stores</a></li>
     <li><a href="{% url about %}">About</a></li>
     {% endactivehref %} 
+
+    The anchors found in the rendered content are cached, so that each
+    render only needs to compare the current path against their hrefs.
     """
+    # The maximum number of distinct rendered contents to cache
+    max_cache_size = 64
+
     def __init__(self, nodelist):
         self.nodelist = nodelist
+        self.cache = {}
+
+    @classmethod
+    def parse(cls, html):
+        """
+        Find the anchors in the given html.
+
+        :return: A list of tuples containing the start and end offsets of
+                 each anchor start tag, the value of its href attribute and
+                 the start tag with an 'active' class attribute.
+        """
+        anchors = []
+
+        for m in ANCHOR_RE.finditer(html):
+            tag = m.group(0)
+
+            href = HREF_RE.search(tag)
+            if not href:
+                continue
+            href = href.group(1) if href.group(1) is not None else href.group(2)
+
+            if CLASS_RE.search(tag):
+                active = CLASS_RE.sub(' class="active"', tag, 1)
+            else:
+                end = -2 if tag.endswith('/>') else -1
+                active = '%s class="active"%s' % (tag[:end].rstrip(), tag[end:])
+
+            anchors.append((m.start(), m.end(), href, active))
+
+        return anchors
 
     def render(self, context):
-        soup = BeautifulSoup(self.nodelist.render(context))
+        html = self.nodelist.render(context)
 
         if context.has_key('request'):
             path = context.get('request').path
 
-            for a in soup.find_all('a'):
-                href = a['href']
+            try:
+                anchors = self.cache[html]
+            except KeyError:
+                if len(self.cache) >= self.max_cache_size:
+                    self.cache.clear()
+                anchors = self.cache[html] = self.parse(html)
 
+            for start, end, href, active in anchors:
                 if href == '/':
                     if path == href:
-                        a['class'] = 'active'
-                        break
+                        return html[:start] + active + html[end:]
                 else:
                     if href in path:
-                        a['class'] = 'active'
-                        break
+                        return html[:start] + active + html[end:]
 
-        return soup
+        return html
@@ -1,16 +1,46 @@
+import BaseHTTPServer
+import SocketServer
+import base64
+import csv
 import datetime
+import hashlib
+import json
+import os
+import re
 import requests
+import tempfile
+import threading
+import time
 import xlrd
 
+from decimal import Decimal
+from StringIO import StringIO
+
 from django.conf import settings
+from django.core.cache import get_cache
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.template import Context, Template
 from django.test import TestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils.http import http_date
 
 from mock import Mock, patch
 
-from olcc.models import ImportRecord, Store, Product, ProductPrice
-from olcc.management.commands import olccfetch
+from olcc.caching import bump_generation, check_cache_size, \
+        clear_last_updated
+from olcc import caching
+from olcc.context_processors import last_updated
+from olcc import instrumentation
+from olcc.geocoding import normalize_address, RateLimiter
+from olcc.models import add_months, GeocodedAddress, ImportRecord, Store, \
+        PriceMover, Product, ProductPrice
+from olcc.management.commands import olccbench, olccfetch, olccimport
+from olcc.management.progress import Progress
+from olcc.pagination import cached_count, KeysetPaginator
+from olcc.search import InvertedIndex, PostgresSearch, escape_like
+from olcc.spatial import haversine, KDTree, to_vector
 
 @patch('olcc.management.commands.olccfetch.call_command')
 @patch.object(requests, 'get')
@@ -21,7 +51,9 @@ class TestFetchCommand(TestCase):
 
         # Configure our Mock HTTP response
         self.mock_get_response = Mock(requests.Response)
-        self.mock_get_response.headers = {'etag': self.etags[0]}
+        self.mock_get_response.status_code = 200
+        self.mock_get_response.headers = {'etag': self.etags[0],
+                'last-modified': 'Sat, 01 Sep 2012 07:00:00 GMT'}
         self.mock_get_response.text = "foo\nbar\n"
         self.mock_get_response.iter_content = Mock(return_value="foo\nbar\n")
 
@@ -62,6 +94,8 @@ class TestFetchCommand(TestCase):
         pi = ImportRecord.objects.all()
         self.assertEqual(pi.count(), 1)
         self.assertEqual(pi[0].url, self.default_url)
+        self.assertEqual(pi[0].last_modified,
+                self.mock_get_response.headers['last-modified'])
 
     def test_command_etag(self, mock_get, mock_command):
         """
@@ -119,6 +153,71 @@ class TestFetchCommand(TestCase):
         # Verify that our import command was now called
         self.assertTrue(mock_command.called)
 
+    def test_conditional_request(self, mock_get, mock_command):
+        """
+        Verify the command makes a conditional request and skips the
+        import when the server responds with a 304.
+        """
+        mock_get.return_value = self.mock_get_response
+        mock_get.return_value.status_code = 304
+
+        last_modified = 'Sat, 01 Sep 2012 07:00:00 GMT'
+        pi = ImportRecord.objects.create(url=self.default_url, etag='foo',
+                last_modified=last_modified)
+
+        call_command('olccfetch', quiet=True)
+
+        # The server's own dates are sent back
+        headers = mock_get.call_args[1]['headers']
+        self.assertEqual(headers['If-None-Match'], '"foo"')
+        self.assertEqual(headers['If-Modified-Since'], last_modified)
+
+        # Without a Last-Modified date only the ETag is sent
+        pi.last_modified = ''
+        pi.save()
+
+        call_command('olccfetch', quiet=True)
+
+        headers = mock_get.call_args[1]['headers']
+        self.assertFalse('If-Modified-Since' in headers)
+
+        self.assertFalse(mock_get.return_value.iter_content.called)
+        self.assertFalse(mock_command.called)
+
+    def test_checksum(self, mock_get, mock_command):
+        """
+        Verify the command skips the import when the content of the file
+        has not changed, even if the ETag has.
+        """
+        mock_get.return_value = self.mock_get_response
+        mock_get.return_value.headers.update({'etag': self.etags[1]})
+
+        checksum = hashlib.md5(self.mock_get_response.text).hexdigest()
+        pi = ImportRecord.objects.create(url=self.default_url,
+                etag=self.etags[0].strip('"'), local_checksum=checksum)
+
+        call_command('olccfetch', quiet=True)
+
+        # The import was skipped but the new ETag was recorded
+        self.assertTrue(mock_get.return_value.iter_content.called)
+        self.assertFalse(mock_command.called)
+
+        self.assertEqual(ImportRecord.objects.count(), 1)
+        self.assertEqual(ImportRecord.objects.get(pk=pi.pk).etag,
+                self.etags[1].strip('"'))
+
+        # A new file is imported and its checksum is recorded
+        mock_get.return_value.text = "foo\nbaz\n"
+        mock_get.return_value.iter_content = Mock(return_value="foo\nbaz\n")
+        mock_get.return_value.headers.update({'etag': self.etags[0]})
+
+        call_command('olccfetch', quiet=True)
+        self.assertTrue(mock_command.called)
+
+        latest = ImportRecord.objects.latest('pk')
+        self.assertEqual(latest.local_checksum,
+                hashlib.md5("foo\nbaz\n").hexdigest())
+
     def test_force(self, mock_get, mock_command):
         """
         Verify that the command will run an import when the force
@@ -196,6 +295,360 @@ class TestFetchCommand(TestCase):
             self.assertEqual(f.read(), self.mock_get_response.text)
 
 
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve a few fake OLCC files, answering conditional and range requests.
+    """
+    files = {
+        '/stores.xls': 'stores',
+        '/prices.csv': 'prices',
+        '/history.csv': 'history',
+        '/large.csv': 'large\n' * 1000,
+    }
+    delay = 0.3
+
+    # Paths which should be interrupted halfway through the next response
+    interrupt = set()
+
+    # Paths which should fail with a server error on the next request
+    unavailable = set()
+
+    # The path and Range header of each request
+    log = []
+
+    def do_GET(self):
+        time.sleep(self.delay)
+
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.log.append((self.path, self.headers.get('Range')))
+
+        if self.path in self.unavailable:
+            self.unavailable.remove(self.path)
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if m and self.headers.get('If-Range') == etag:
+            start = int(m.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start,
+                len(body) - 1, len(body)))
+            body = body[start:]
+        else:
+            self.send_response(200)
+            self.send_header('Content-MD5',
+                    base64.b64encode(hashlib.md5(body).digest()))
+
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.path in self.interrupt:
+            self.interrupt.remove(self.path)
+            body = body[:len(body) / 2]
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+@patch('olcc.management.commands.olccfetch.call_command')
+class TestFetchManifest(TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        base = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.sources = [
+            {'url': base + '/prices.csv', 'import_type': 'csv_prices'},
+            {'url': base + '/history.csv', 'import_type': 'csv_prices'},
+            {'url': base + '/stores.xls', 'import_type': 'stores'},
+        ]
+
+        fd, self.manifest = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(self.sources, f)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.manifest)
+
+    def test_manifest(self, mock_command):
+        """
+        Verify the files in a manifest are fetched concurrently and
+        imported in order.
+        """
+        start = time.time()
+        call_command('olccfetch', quiet=True, manifest=self.manifest)
+        elapsed = time.time() - start
+
+        # The files were downloaded at the same time
+        self.assertTrue(elapsed < StandInHandler.delay * len(self.sources))
+
+        # Stores are imported first and 'olccperiodic' runs last
+        calls = [(c[0][0], c[1].get('import_type')) for c in
+                mock_command.call_args_list]
+        self.assertEqual(calls, [
+            ('olccimport', 'stores'),
+            ('olccimport', 'csv_prices'),
+            ('olccimport', 'csv_prices'),
+            ('olccperiodic', None),
+        ])
+
+        # Each import was called with the downloaded file
+        for c in mock_command.call_args_list[:3]:
+            with open(c[0][1], 'rb') as f:
+                self.assertTrue(f.read() in StandInHandler.files.values())
+
+        # The ETag of each source was recorded
+        for source in self.sources:
+            record = ImportRecord.objects.get(url=source['url'])
+            self.assertEqual(len(record.etag), 32)
+
+        # Nothing has changed, so nothing is imported
+        mock_command.reset_mock()
+        call_command('olccfetch', quiet=True, manifest=self.manifest)
+
+        self.assertFalse(mock_command.called)
+        self.assertEqual(ImportRecord.objects.count(), len(self.sources))
+
+    def test_periodic(self, mock_command):
+        """
+        Verify the periodic update runs after a manifest import, whatever
+        the day of the month.
+        """
+        this_month = datetime.date.today().replace(day=1)
+        product = Product.objects.create(title='Gin', code='4177B')
+        ProductPrice.objects.create(product=product, amount='9.95',
+                effective_date=add_months(this_month, -1))
+        ProductPrice.objects.create(product=product, amount='7.95',
+                effective_date=this_month)
+
+        # Skip the imports, but run the real periodic update
+        def run(name, *args, **kwargs):
+            if name == 'olccperiodic':
+                call_command(name, *args, **kwargs)
+        mock_command.side_effect = run
+
+        call_command('olccfetch', quiet=True, manifest=self.manifest)
+
+        self.assertTrue(Product.objects.get(pk=product.pk).on_sale)
+        self.assertEqual(PriceMover.objects.get(product=product).delta,
+                Decimal('-2.00'))
+
+    def test_resume(self, mock_command):
+        """
+        Verify an interrupted download is resumed with a range request.
+        """
+        url = self.sources[0]['url'].replace('prices', 'large')
+
+        StandInHandler.log = []
+        StandInHandler.interrupt.add('/large.csv')
+
+        call_command('olccfetch', quiet=True, url=url, backoff=0)
+
+        self.assertEqual(StandInHandler.log, [
+            ('/large.csv', None),
+            ('/large.csv', 'bytes=%s-' % (len(StandInHandler.files['/large.csv']) / 2)),
+        ])
+
+        # The complete file was imported
+        with open(mock_command.call_args[0][1], 'rb') as f:
+            self.assertEqual(f.read(), StandInHandler.files['/large.csv'])
+
+        record = ImportRecord.objects.get(url=url)
+        self.assertEqual(record.local_checksum,
+                hashlib.md5(StandInHandler.files['/large.csv']).hexdigest())
+
+        # The download and its retry were recorded in the summary
+        summary = json.loads(record.summary)
+        self.assertTrue('download' in summary['phases'])
+        self.assertEqual(summary['counters']['retries'], 1)
+        self.assertEqual(summary['counters']['bytes'],
+                len(StandInHandler.files['/large.csv']))
+
+    def test_server_error(self, mock_command):
+        """
+        Verify a server error is retried, and that a failed download
+        leaves no temp file behind.
+        """
+        tempdir = tempfile.mkdtemp()
+        saved, tempfile.tempdir = tempfile.tempdir, tempdir
+
+        try:
+            url = self.sources[0]['url']
+            StandInHandler.unavailable.add('/prices.csv')
+
+            call_command('olccfetch', quiet=True, url=url, backoff=0)
+
+            with open(mock_command.call_args[0][1], 'rb') as f:
+                self.assertEqual(f.read(), StandInHandler.files['/prices.csv'])
+            os.remove(mock_command.call_args[0][1])
+
+            # A missing file is not retried and its temp file is removed
+            mock_command.reset_mock()
+            # The command fails with a CommandError, which exits
+            print "\nTest Output: Ignore Error"
+            self.assertRaises(SystemExit, call_command, 'olccfetch',
+                    quiet=True, url=url.replace('prices', 'missing'),
+                    backoff=0)
+
+            self.assertFalse(mock_command.called)
+            self.assertEqual(os.listdir(tempdir), [])
+        finally:
+            tempfile.tempdir = saved
+            os.rmdir(tempdir)
+
+    def test_failed_download(self, mock_command):
+        """
+        Verify a failed download is reported, the imports which follow
+        it are skipped and the command fails.
+        """
+        sources = [
+            {'url': 'http://127.0.0.1:1/stores.xls', 'import_type': 'stores'},
+            self.sources[0],
+        ]
+        with open(self.manifest, 'wb') as f:
+            json.dump(sources, f)
+
+        # The command fails with a CommandError, which exits
+        print "\nTest Output: Ignore Error"
+        self.assertRaises(SystemExit, call_command, 'olccfetch',
+                quiet=True, manifest=self.manifest, retries=0)
+
+        # Prices are not imported without the stores
+        self.assertFalse(mock_command.called)
+        self.assertEqual(ImportRecord.objects.count(), 0)
+
+        # A failed price list still lets the stores be imported, but
+        # the periodic update waits for the next fetch
+        sources = [
+            self.sources[2],
+            {'url': 'http://127.0.0.1:1/prices.csv', 'import_type': 'csv_prices'},
+        ]
+        with open(self.manifest, 'wb') as f:
+            json.dump(sources, f)
+
+        print "Test Output: Ignore Error"
+        self.assertRaises(SystemExit, call_command, 'olccfetch',
+                quiet=True, manifest=self.manifest, retries=0)
+
+        calls = [(c[0][0], c[1].get('import_type')) for c in
+                mock_command.call_args_list]
+        self.assertEqual(calls, [('olccimport', 'stores')])
+        self.assertEqual(ImportRecord.objects.get().url, self.sources[2]['url'])
+
+    def test_failed_import(self, mock_command):
+        """
+        Verify no import record is created if the import fails, so that
+        the next fetch will retry it.
+        """
+        mock_command.side_effect = RuntimeError('Import failed!')
+
+        url = self.sources[0]['url']
+        self.assertRaises(RuntimeError, call_command, 'olccfetch',
+                quiet=True, url=url)
+        self.assertEqual(ImportRecord.objects.count(), 0)
+
+class TestProgress(TestCase):
+    def test_phases(self):
+        """
+        Verify time spent in nested phases is only counted once.
+        """
+        progress = Progress(StringIO(), quiet=True)
+
+        def rows():
+            for i in range(3):
+                time.sleep(0.01)
+                yield i
+
+        for row in progress.timed(rows(), 'parse'):
+            with progress.phase('write'):
+                time.sleep(0.02)
+            progress.advance()
+
+        summary = progress.summary()
+        self.assertEqual(summary['rows'], 3)
+        self.assertEqual(summary['phases'].keys(), ['parse', 'write'])
+        self.assertTrue(0.03 <= summary['phases']['parse'] < 0.06)
+        self.assertTrue(0.06 <= summary['phases']['write'] < 0.09)
+
+    def test_report(self):
+        """
+        Verify progress is reported at most once per interval.
+        """
+        out = StringIO()
+        progress = Progress(out, interval=60, total=1000)
+
+        for i in range(500):
+            progress.advance()
+        self.assertEqual(out.getvalue(), '')
+
+        progress.last_report -= 60
+        progress.advance()
+        self.assertTrue(out.getvalue().startswith('501 / 1000 rows (50%)'))
+        self.assertTrue('ETA' in out.getvalue())
+
+        progress.count('invalid_rows')
+        progress.count('invalid_rows', 2)
+        summary = progress.finish()
+        self.assertEqual(summary['counters'], {'invalid_rows': 3})
+        self.assertTrue('invalid_rows: 3' in out.getvalue())
+
+    def test_import(self):
+        """
+        Verify the import reports its phases to a given Progress.
+        """
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        olccbench.write_price_csv(path, olccbench.price_rows(20, months=2))
+
+        progress = Progress(StringIO(), quiet=True)
+        try:
+            call_command('olccimport', path, import_type='csv_prices',
+                    bulk=True, quiet=True, progress=progress)
+        finally:
+            os.remove(path)
+
+        summary = progress.summary()
+        self.assertEqual(summary['rows'], progress.total)
+        for phase in ('parse', 'validate', 'write', 'refresh'):
+            self.assertTrue(phase in summary['phases'])
+        self.assertTrue(summary['counters']['created_products'] > 0)
+
+class FakeGeocoder(object):
+    """
+    A geocoder which records the addresses it is asked to geocode
+    instead of making requests.
+    """
+    calls = []
+
+    def geocode(self, address):
+        FakeGeocoder.calls.append(address)
+        if 'nowhere' in address.lower():
+            raise ValueError("No address found")
+        if 'offline' in address.lower():
+            raise requests.ConnectionError("Connection refused")
+        return ('%s, Portland, OR' % address, (45.5, -122.6))
+
 class TestImportCommand(TestCase):
     def setUp(self):
         self.stores = [
@@ -275,6 +728,171 @@ class TestImportCommand(TestCase):
             self.assertEqual(s.address, s.address_raw)
             i += 1
 
+    @patch.object(xlrd, 'open_workbook')
+    def test_import_stores_upsert(self, mock_open_workbook):
+        """
+        Verify a store import only writes the stores that have changed.
+        """
+        def do_import(rows):
+            sheet_mock = Mock()
+            sheet_mock.nrows = len(rows)
+            sheet_mock.row_values = Mock(side_effect=rows)
+            mock_open_workbook.return_value.sheet_by_index = \
+                    Mock(return_value=sheet_mock)
+
+            call_command('olccimport', '/foo/bar/baz.xls', quiet=True,
+                    import_type='stores', geocode=False)
+
+        do_import(self.stores)
+        self.assertEqual(Store.objects.count(), len(self.stores))
+
+        # Keep the geocoded location of stores that have not moved
+        Store.objects.filter(key=12345).update(address='1 Main St',
+                latitude='45.5', longitude='-122.6')
+
+        # Re-importing the same rows is a single read
+        with self.assertNumQueries(1):
+            do_import(self.stores)
+
+        store = Store.objects.get(key=12345)
+        self.assertEqual(store.address, '1 Main St')
+        self.assertEqual(store.latitude, Decimal('45.5'))
+
+        # Changed rows are written with a single update
+        stores = list(self.stores)
+        stores[0] = stores[0][:5] + ('New County',)
+        stores[1] = stores[1][:4] + ('New Hours',) + stores[1][5:]
+        with self.assertNumQueries(2):
+            do_import(stores)
+
+        store = Store.objects.get(key=12345)
+        self.assertEqual(store.county, 'New County')
+        self.assertEqual(store.hours_raw, self.stores[0][4])
+        store = Store.objects.get(key=54321)
+        self.assertEqual(store.hours_raw, 'New Hours')
+        self.assertEqual(store.county, self.stores[1][5])
+        self.assertEqual(Store.objects.count(), len(self.stores))
+
+    @override_settings(OLCC_GEOCODER='olcc.tests.FakeGeocoder',
+            OLCC_GEOCODER_QPS=1000)
+    @patch.object(xlrd, 'open_workbook')
+    def test_import_stores_geocode(self, mock_open_workbook):
+        """
+        Verify store addresses are geocoded once and read from
+        the geocode cache by subsequent imports.
+        """
+        stores = [
+            (12345, 'First', '(842) 123-4567', '1 Main St', 'Hours', 'County'),
+            (54321, 'Second', '(503) 123-4567', '1 MAIN ST.', 'Hours', 'County'),
+            (12321, 'Third', '(541) 123-4567', 'Nowhere', 'Hours', 'County'),
+        ]
+
+        def do_import(rows):
+            sheet_mock = Mock()
+            sheet_mock.nrows = len(rows)
+            sheet_mock.row_values = Mock(side_effect=rows)
+            mock_open_workbook.return_value.sheet_by_index = \
+                    Mock(return_value=sheet_mock)
+
+            call_command('olccimport', '/foo/bar/baz.xls', quiet=True,
+                    import_type='stores')
+
+        FakeGeocoder.calls = []
+        print "\nTest Output: Ignore Error"
+        do_import(stores)
+
+        # Equivalent addresses share a single request
+        self.assertEqual(len(FakeGeocoder.calls), 2)
+        self.assertEqual(GeocodedAddress.objects.count(), 1)
+
+        first, second = Store.objects.get(key=12345), Store.objects.get(key=54321)
+        self.assertEqual(first.address, second.address)
+        self.assertEqual(second.address_raw, '1 MAIN ST.')
+        self.assertEqual(second.latitude, Decimal('45.5'))
+
+        # Failed addresses keep their raw address
+        store = Store.objects.get(key=12321)
+        self.assertEqual(store.address, 'Nowhere')
+        self.assertEqual(store.latitude, 0)
+
+        # Only addresses missing from the cache are geocoded again
+        FakeGeocoder.calls = []
+        stores[1] = stores[1][:3] + ('2 Main St',) + stores[1][4:]
+        print "Test Output: Ignore Error"
+        do_import(stores)
+
+        self.assertEqual(sorted(FakeGeocoder.calls), ['2 Main St', 'Nowhere'])
+        self.assertEqual(Store.objects.get(key=12345).latitude, Decimal('45.5'))
+        self.assertEqual(Store.objects.get(key=54321).address,
+                '2 Main St, Portland, OR')
+
+    @override_settings(OLCC_GEOCODER='olcc.tests.FakeGeocoder',
+            OLCC_GEOCODER_QPS=1000)
+    @patch.object(xlrd, 'open_workbook')
+    def test_import_stores_geocode_error(self, mock_open_workbook):
+        """
+        Verify a geocoder error only leaves its own store unlocated.
+        """
+        stores = [
+            (12345, 'First', '(842) 123-4567', '1 Main St', 'Hours', 'County'),
+            (54321, 'Second', '(503) 123-4567', '1 Offline Rd', 'Hours', 'County'),
+        ]
+
+        sheet_mock = Mock()
+        sheet_mock.nrows = len(stores)
+        sheet_mock.row_values = Mock(side_effect=stores)
+        mock_open_workbook.return_value.sheet_by_index = \
+                Mock(return_value=sheet_mock)
+
+        FakeGeocoder.calls = []
+        print "\nTest Output: Ignore Error"
+        call_command('olccimport', '/foo/bar/baz.xls', quiet=True,
+                import_type='stores')
+
+        self.assertEqual(len(FakeGeocoder.calls), 2)
+        self.assertEqual(Store.objects.get(key=12345).latitude, Decimal('45.5'))
+
+        store = Store.objects.get(key=54321)
+        self.assertEqual(store.address, '1 Offline Rd')
+        self.assertEqual(store.latitude, 0)
+
+        # The failed address is not cached, so it is retried next time
+        self.assertEqual(GeocodedAddress.objects.count(), 1)
+
+    @patch('olcc.management.commands.olccimport.geocode_addresses')
+    @patch.object(xlrd, 'open_workbook')
+    def test_geocode_options(self, mock_open_workbook, mock_geocode):
+        """
+        Verify the geocoding rate and workers can be set on the command line.
+        """
+        sheet_mock = Mock()
+        sheet_mock.nrows = 1
+        sheet_mock.row_values = Mock(side_effect=self.stores[:1])
+        mock_open_workbook.return_value.sheet_by_index = \
+                Mock(return_value=sheet_mock)
+        mock_geocode.return_value = {}
+
+        print "\nTest Output: Ignore Error"
+        olccimport.Command().run_from_argv(['manage.py', 'olccimport',
+            '/foo/bar/baz.xls', '--import-type=stores', '--quiet',
+            '--geocode-qps', '5.5', '--geocode-workers', '2'])
+
+        self.assertEqual(mock_geocode.call_args[1],
+                {'qps': 5.5, 'workers': 2})
+
+    def test_geocode_helpers(self):
+        """
+        Test address normalization and the geocoder rate limiter.
+        """
+        self.assertEqual(normalize_address(' 1  Main St.,\tPortland '),
+                '1 main st portland')
+
+        limiter = RateLimiter(20)
+        start = time.time()
+        for n in range(5):
+            limiter.wait()
+        self.assertTrue(time.time() - start >= 0.19)
+
     @patch.object(xlrd, 'open_workbook')
     def test_import_prices(self, mock_open_workbook):
         """
@@ -336,6 +954,136 @@ class TestImportCommand(TestCase):
             # Increment the counter
             i += 1
 
+    @patch.object(xlrd, 'open_workbook')
+    def test_import_prices_bulk(self, mock_open_workbook):
+        """
+        Test a prices file import using the bulk import mode.
+        """
+        # Configure our Mocks
+        sheet_mock = Mock()
+        sheet_mock.nrows = len(self.prices)
+        sheet_mock.row_values = Mock(side_effect=self.prices)
+
+        wb_mock = Mock()
+        wb_mock.sheet_by_index = Mock(return_value=sheet_mock)
+
+        mock_open_workbook.return_value = wb_mock
+
+        # Create an existing product which should be updated
+        Product.objects.create(code='0212H', title='Old Overholt',
+                size='750 ML')
+
+        # Call our management command
+        path = 'foo/bar/baz/xml'
+        call_command('olccimport', path, quiet=True, import_type='prices',
+                bulk=True)
+
+        # Verify the expected number of objects were created
+        self.assertEqual(Product.objects.count(), len(self.prices))
+        self.assertEqual(ProductPrice.objects.count(), len(self.prices))
+
+        # Verify the product data
+        for row in self.prices:
+            p = Product.objects.get(code=row[0])
+            self.assertEqual(row[1], p.status)
+            self.assertEqual(row[2], p.title.upper())
+            self.assertEqual(row[3], p.size)
+            self.assertEqual(row[5], p.proof)
+            self.assertEqual(row[6], p.bottles_per_case)
+            self.assertEqual(p.slug, row[0].lower())
+            self.assertEqual(p.prices.count(), 1)
+
+        # Importing the same file again should not create any duplicates
+        sheet_mock.row_values = Mock(side_effect=self.prices)
+        call_command('olccimport', path, quiet=True, import_type='prices',
+                bulk=True)
+
+        self.assertEqual(Product.objects.count(), len(self.prices))
+        self.assertEqual(ProductPrice.objects.count(), len(self.prices))
+
+    def test_import_csv_prices_chunked(self):
+        """
+        Test a bulk CSV prices file import written in small chunks.
+        """
+        rows = list(self.prices)
+
+        # A repeated product code and an invalid effective date
+        rows.append(('0212H', '@', 'OLD OVERHOLT', '1.75 L', '4 YRS', 80, 6,
+            41.95, '01/01/2012'))
+        rows.append(('4176B', '@', 'COLD TREE GIN', '750 ML', '', 80, 12,
+            29.95, 'foo'))
+
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            csv.writer(f).writerows(rows)
+
+        try:
+            call_command('olccimport', path, quiet=True,
+                    import_type='csv_prices', bulk=True, chunk_size=2)
+        finally:
+            os.remove(path)
+
+        # Verify the expected number of objects were created
+        self.assertEqual(Product.objects.count(), len(self.prices))
+        self.assertEqual(ProductPrice.objects.count(), len(self.prices) + 1)
+
+        product = Product.objects.get(code='0212H')
+        self.assertEqual(product.prices.count(), 2)
+        self.assertEqual(product.prices.all()[1].effective_date,
+                datetime.date(2012, 1, 1))
+
+class TestImportBenchmark(TestCase):
+    def test_private_cache(self):
+        """
+        Verify imports made by the benchmark don't expire the site's cache.
+        """
+        generation = caching.generation()
+        Product.objects.create(title='Gin', code='4177B')
+        Product.objects.clear_sample()
+        Product.objects.sample(1)
+
+        with olccbench.private_cache():
+            bump_generation()
+            Product.objects.clear_sample()
+
+        self.assertEqual(caching.generation(), generation)
+        with self.assertNumQueries(1):
+            Product.objects.sample(1)
+
+    def test_price_rows(self):
+        """
+        Verify synthetic price lists contain valid products and a
+        price per product per month.
+        """
+        rows = list(olccbench.price_rows(20, months=3))
+        self.assertEqual(len(rows), 60)
+        self.assertEqual(len(set(r[0] for r in rows)), 20)
+        self.assertEqual(len(set(r[-1] for r in rows)), 3)
+        self.assertTrue(all(Product.is_code_valid(r[0]) for r in rows))
+
+    def test_run_import(self):
+        """
+        Verify the import benchmark times an import and counts its queries.
+        """
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        olccbench.write_price_csv(path, olccbench.price_rows(20, months=2))
+
+        command = olccbench.Command()
+        command.stdout = open(os.devnull, 'w')
+        command.bulk = True
+
+        try:
+            result = command.run_import('test', path, 'csv_prices', 40)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(result['products'], 20)
+        self.assertEqual(result['prices'], 40)
+        self.assertTrue(result['queries'] > 0)
+        self.assertTrue(result['rows_per_second'] > 0)
+        self.assertTrue(result['peak_rss_kb'] > 0)
+
 class TestPeriodicCommand(TestCase):
     def setUp(self):
         # Three products, with this month and last month's price, on sale flag
@@ -380,3 +1128,748 @@ class TestPeriodicCommand(TestCase):
         # Verify the correct two products are now on sale
         for p in Product.objects.on_sale():
             self.assertTrue(p.pk > 0)
+
+    def test_on_sale_queries(self):
+        """
+        Verify the on sale flags are calculated with a constant number of
+        queries, and that products without a price for last month are
+        left untouched.
+        """
+        p = Product.objects.create(title='Product 4', code='012', on_sale=True)
+        ProductPrice.objects.create(amount='1.99',
+                effective_date=datetime.date.today().replace(day=1), product=p)
+
+        # Four queries for the on sale flags, four for the price movers
+        with self.assertNumQueries(8):
+            call_command('olccperiodic', quiet=True, force=True)
+
+        self.assertEqual(3, Product.objects.on_sale().count())
+        self.assertTrue(Product.objects.get(pk=p.pk).on_sale)
+
+    def test_with_prices(self):
+        """
+        Verify prices are attached to products with a single extra query.
+        """
+        this_month = datetime.date.today().replace(day=1)
+
+        with self.assertNumQueries(2):
+            products = list(Product.objects.with_prices().order_by('title'))
+
+        with self.assertNumQueries(0):
+            for p in products:
+                self.assertTrue(p.price is not None)
+                self.assertTrue(p.price_for(add_months(this_month, -1)))
+                self.assertEqual(p.price_for(add_months(this_month, 1)), None)
+
+        # Prices outside of the attached window are queried
+        with self.assertNumQueries(1):
+            self.assertEqual(products[0].price_for(add_months(this_month, 2)),
+                    None)
+
+        # Filtering and slicing keep the attached prices
+        with self.assertNumQueries(2):
+            p = Product.objects.with_prices().filter(code='456')[0]
+            self.assertEqual(p.price.amount, Decimal('3.49'))
+
+    def test_sample(self):
+        """
+        Verify random products are sampled from the cached pool of ids.
+        """
+        Product.objects.clear_sample()
+
+        with self.assertNumQueries(2):
+            products = Product.objects.sample(2)
+        self.assertEqual(len(products), 2)
+
+        # The pool of ids is now cached
+        with self.assertNumQueries(1):
+            products = Product.objects.sample(5,
+                    exclude=[self.products[0].pk])
+        self.assertEqual(set(products), set(self.products[1:]))
+
+        products = Product.objects.sample(5, on_sale=True)
+        self.assertEqual(products, [self.products[0]])
+
+    def test_update_prices(self):
+        """
+        Verify the denormalized product prices are refreshed.
+        """
+        # Invoke the periodic command
+        call_command('olccperiodic', quiet=True, force=True)
+
+        for p in Product.objects.all():
+            self.assertEqual(p.current_price, p.price.amount)
+            self.assertEqual(p.next_price, None)
+
+            if p.on_sale:
+                self.assertEqual(p.current_price, Decimal('3.49'))
+                self.assertEqual(p.previous_price, Decimal('5.99'))
+                self.assertEqual(p.price_change, Decimal('-2.50'))
+            else:
+                self.assertEqual(p.current_price, Decimal('5.99'))
+                self.assertEqual(p.previous_price, Decimal('3.49'))
+                self.assertEqual(p.price_change, Decimal('2.50'))
+
+    def test_movers(self):
+        """
+        Verify the products whose prices moved are recorded once, and
+        only for the latest months.
+        """
+        call_command('olccperiodic', quiet=True, force=True)
+
+        this_month = datetime.date.today().replace(day=1)
+        drops = list(PriceMover.objects.top(this_month))
+        self.assertEqual([m.product for m in drops], self.products[1:])
+        self.assertEqual(drops[0].previous_amount, Decimal('5.99'))
+        self.assertEqual(drops[0].amount, Decimal('3.49'))
+        self.assertEqual(drops[0].delta, Decimal('-2.50'))
+        self.assertEqual(Decimal(str(drops[0].percent_delta)), Decimal('-41.74'))
+
+        increases = list(PriceMover.objects.top(this_month, 'percent_increase'))
+        self.assertEqual([m.product for m in increases], self.products[:1])
+        self.assertEqual(Decimal(str(increases[0].percent_delta)),
+                Decimal('71.63'))
+
+        # Nothing is recorded twice
+        self.assertEqual(PriceMover.objects.update_movers(), 0)
+
+        # Next month's prices are picked up, but older months are not
+        # looked at again unless the movers are rebuilt.
+        next_month = add_months(this_month, 1)
+        for p in self.products:
+            ProductPrice.objects.create(amount='4.99', effective_date=next_month,
+                    product=p)
+            ProductPrice.objects.create(amount='1.99',
+                    effective_date=add_months(this_month, -2), product=p)
+
+        self.assertEqual(PriceMover.objects.update_movers(), 3)
+        self.assertEqual(PriceMover.objects.update_movers(rebuild=True), 3)
+        self.assertEqual(PriceMover.objects.count(), 9)
+
+    def test_movers_view(self):
+        """
+        Verify the movers are listed by /sale/ and the API.
+        """
+        call_command('olccperiodic', quiet=True, force=True)
+        this_month = datetime.date.today().replace(day=1)
+
+        response = self.client.get('/sale/?sort=drop')
+        self.assertEqual([m.product for m in
+            response.context['movers_page'].object_list], self.products[1:])
+
+        response = self.client.get('/sale/?sort=increase&month=%s' %
+                this_month.strftime('%Y-%m'))
+        self.assertEqual([m.product for m in
+            response.context['movers_page'].object_list], self.products[:1])
+
+        self.assertEqual(self.client.get('/sale/?sort=foo').status_code, 404)
+        self.assertEqual(self.client.get('/sale/?sort=drop&month=foo')\
+                .status_code, 404)
+
+        url = '/api/v1/mover/?format=json&delta__lt=0&order_by=delta&month=%s' \
+                % this_month.isoformat()
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual(len(data['objects']), 2)
+        self.assertEqual(Decimal(data['objects'][0]['delta']), Decimal('-2.50'))
+        self.assertTrue(data['objects'][0]['product'].startswith(
+            '/api/v1/product/'))
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.products = [
+            Product.objects.create(title='Cold Tree Gin', code='4176B'),
+            Product.objects.create(title='Gin', code='4177B', on_sale=True),
+            Product.objects.create(title='Ginger Liqueur', code='4178B'),
+            Product.objects.create(title='Old Overholt', code='0212H'),
+        ]
+
+    def test_postgres_without_trigram(self):
+        """
+        Verify Postgres search only ranks by trigram similarity when the
+        pg_trgm extension is installed.
+        """
+        search = PostgresSearch()
+        try:
+            for installed in (True, False):
+                PostgresSearch.has_trigram = installed
+                sql = str(search.queryset('gin', Product.objects.all()).query)
+                self.assertEqual('similarity(' in sql, installed)
+                self.assertTrue('ts_rank(' in sql)
+        finally:
+            PostgresSearch.has_trigram = None
+
+    def test_escape_like(self):
+        """
+        Verify LIKE wildcards in a search query are matched literally.
+        """
+        self.assertEqual(escape_like('gin'), 'gin')
+        self.assertEqual(escape_like('100%'), '100\\%')
+        self.assertEqual(escape_like('a_b'), 'a\\_b')
+        self.assertEqual(escape_like('a\\b'), 'a\\\\b')
+
+    def test_search(self):
+        """
+        Verify the in-process index ranks matching products.
+        """
+        index = InvertedIndex()
+
+        # Whole words rank above prefixes and shorter titles rank first
+        pks = index.search('gin', Product.objects.all())
+        self.assertEqual(pks, [p.pk for p in self.products[1], self.products[0],
+            self.products[2]])
+
+        # Every word must match
+        pks = index.search('cold gin', Product.objects.all())
+        self.assertEqual(pks, [self.products[0].pk])
+
+        # Product codes match exactly
+        pks = index.search('0212h', Product.objects.all())
+        self.assertEqual(pks, [self.products[3].pk])
+
+        # Results are restricted to the given products
+        pks = index.search('gin', Product.objects.on_sale())
+        self.assertEqual(pks, [self.products[1].pk])
+
+    def test_refresh(self):
+        """
+        Verify the index picks up new products.
+        """
+        index = InvertedIndex()
+        self.assertEqual(index.search('rye', Product.objects.all()), [])
+
+        p = Product.objects.create(title='Rye Whiskey', code='6482B')
+        self.assertEqual(index.search('rye', Product.objects.all()), [p.pk])
+
+class TestActiveHref(TestCase):
+    def render(self, path):
+        t = Template('{% load olcc %}{% activehref %}'
+                '<a href="/">Home</a>'
+                '<a class="nav" href="/products/">Products</a>'
+                '<a href="/sale/">On Sale</a>'
+                '{% endactivehref %}')
+        return t.render(Context({'request': RequestFactory().get(path)}))
+
+    def test_active(self):
+        """
+        Verify the first anchor matching the current path is made active.
+        """
+        self.assertEqual(self.render('/'),
+                '<a href="/" class="active">Home</a>'
+                '<a class="nav" href="/products/">Products</a>'
+                '<a href="/sale/">On Sale</a>')
+
+        self.assertEqual(self.render('/products/2/'),
+                '<a href="/">Home</a>'
+                '<a class="active" href="/products/">Products</a>'
+                '<a href="/sale/">On Sale</a>')
+
+        self.assertEqual(self.render('/sale/'),
+                '<a href="/">Home</a>'
+                '<a class="nav" href="/products/">Products</a>'
+                '<a href="/sale/" class="active">On Sale</a>')
+
+        self.assertEqual(self.render('/stores/'),
+                '<a href="/">Home</a>'
+                '<a class="nav" href="/products/">Products</a>'
+                '<a href="/sale/">On Sale</a>')
+
+class TestCacheSize(TestCase):
+    def test_check_cache_size(self):
+        """
+        Verify the cache is checked for room for every product page.
+        """
+        # The configured cache can hold the whole catalog
+        self.assertEqual(check_cache_size(10000), None)
+
+        small = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                OPTIONS={'MAX_ENTRIES': 300})
+        self.assertEqual(check_cache_size(50, small), None)
+        self.assertTrue('300 entries' in check_cache_size(100, small))
+
+class TestLastUpdated(TestCase):
+    def test_cache(self):
+        """
+        Verify the last import date is cached until a new import is saved.
+        """
+        request = RequestFactory().get('/')
+        clear_last_updated()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(last_updated(request), {})
+            self.assertEqual(last_updated(request), {})
+
+        # Saving an import invalidates the cache
+        record = ImportRecord.objects.create(url='http://example.com/')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(last_updated(request),
+                    {'last_updated': record.created_at})
+            self.assertEqual(last_updated(request),
+                    {'last_updated': record.created_at})
+
+class TestConditionalViews(TestCase):
+    def setUp(self):
+        Product.objects.create(title='Gin', code='4177B')
+
+    def test_not_modified(self):
+        """
+        Verify pages answer conditional requests without any queries.
+        """
+        for url in ('/', '/products/', '/products/4177b/', '/stores/',
+                '/api/v1/product/'):
+            # The first response may set a CSRF cookie, which is part of
+            # the ETag of any later responses.
+            self.client.get(url)
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header('Last-Modified'))
+
+            etag = response['ETag']
+
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+
+            # A new import changes the ETag
+            ImportRecord.objects.create(url='http://example.com/')
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+    def test_last_modified(self):
+        """
+        Verify the Last-Modified date is sent as UTC.
+        """
+        record = ImportRecord.objects.create(url='http://example.com/')
+        last_modified = http_date(time.mktime(record.created_at.timetuple()))
+
+        response = self.client.get('/')
+        self.assertEqual(response['Last-Modified'], last_modified)
+
+        response = self.client.get('/',
+                HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+class TestPageCache(TestCase):
+    def setUp(self):
+        Product.objects.create(title='Gin', code='4177B')
+        bump_generation()
+
+    def test_cache_page(self):
+        """
+        Verify pages are cached until the cache generation is bumped.
+        """
+        for url in ('/products/', '/products/4177b/', '/stores/multnomah/'):
+            # The first response may set a CSRF cookie
+            self.client.get(url)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+            with self.assertNumQueries(0):
+                cached = self.client.get(url)
+            self.assertEqual(cached.content, response.content)
+
+        # Updates are not visible until the generation is bumped
+        Product.objects.update(title='Rum')
+        self.assertTrue('Gin' in self.client.get('/products/4177b/').content)
+
+        bump_generation()
+        self.assertTrue('Rum' in self.client.get('/products/4177b/').content)
+
+    def test_csrf_cookie(self):
+        """
+        Verify pages containing a CSRF token are not cached for visitors
+        without a CSRF cookie.
+        """
+        self.client.get('/stores/')
+        self.client.cookies.clear()
+
+        response = self.client.get('/stores/')
+        self.assertTrue(response.cookies.has_key(settings.CSRF_COOKIE_NAME))
+
+class TestNearestStores(TestCase):
+    def setUp(self):
+        self.locations = [
+            (1, 'Portland', '45.523', '-122.676'),
+            (2, 'Salem', '44.943', '-123.035'),
+            (3, 'Eugene', '44.052', '-123.087'),
+            (4, 'Bend', '44.058', '-121.315'),
+            (5, 'Unlocated', '0', '0'),
+        ]
+
+        for key, name, lat, lng in self.locations:
+            Store.objects.create(key=key, name=name, latitude=lat,
+                    longitude=lng, county='County')
+
+        bump_generation()
+
+    def test_kdtree(self):
+        """
+        Verify the tree finds the same stores as a brute force search.
+        """
+        import random
+        rand = random.Random(42)
+
+        points = [(rand.uniform(-90, 90), rand.uniform(-180, 180))
+                for i in range(500)]
+        tree = KDTree([(to_vector(lat, lng), i) for i, (lat, lng)
+            in enumerate(points)])
+
+        for n in range(20):
+            lat, lng = rand.uniform(-90, 90), rand.uniform(-180, 180)
+            expected = sorted(range(len(points)),
+                    key=lambda i: haversine(lat, lng, *points[i]))[:5]
+            found = [i for d, i in tree.nearest(to_vector(lat, lng), 5)]
+            self.assertEqual(found, expected)
+
+    def test_store_near_view(self):
+        """
+        Verify the nearest stores are listed in order with their distances.
+        """
+        response = self.client.get('/stores/near/?lat=45.0&lng=-123.0&k=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([s.name for s in response.context['stores']],
+                ['Salem', 'Portland', 'Eugene'])
+        self.assertAlmostEqual(response.context['stores'][0].distance,
+                haversine(45.0, -123.0, 44.943, -123.035))
+
+        # Stores without a location are never returned
+        response = self.client.get('/stores/near/?lat=0&lng=0&k=10')
+        self.assertEqual(len(response.context['stores']), 4)
+
+        for url in ('/stores/near/', '/stores/near/?lat=95&lng=0',
+                '/stores/near/?lat=a&lng=b'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_store_near_api(self):
+        """
+        Verify the API returns the nearest stores and is rebuilt
+        after an import.
+        """
+        url = '/api/v1/store/near/?lat=44.0&lng=-121.0&k=2&format=json'
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual([o['key'] for o in data['objects']], [4, 3])
+        self.assertTrue(data['objects'][0]['distance'] < 20)
+
+        Store.objects.create(key=6, name='Redmond', latitude='44.272',
+                longitude='-121.173', county='County')
+        bump_generation()
+
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual([o['key'] for o in data['objects']], [4, 6])
+
+        url = '/api/v1/store/near/?lat=44.0&format=json'
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+class TestKeysetPagination(TestCase):
+    def setUp(self):
+        titles = ['Rum', 'Gin', 'Vodka', 'Gin', 'Brandy', 'Rum', 'Whiskey']
+        for i, title in enumerate(titles):
+            Product.objects.create(title=title, code='%sB' % (1000 + i),
+                    slug='%sb' % (1000 + i))
+
+        self.expected = list(Product.objects.order_by('title', 'pk')\
+                .values_list('pk', flat=True))
+        bump_generation()
+
+    def test_paginator(self):
+        """
+        Verify walking the pages forwards and backwards visits every
+        product once, in order.
+        """
+        p = KeysetPaginator(Product.objects.all(), 3)
+
+        pks, page = [], p.page()
+        self.assertFalse(page.has_previous())
+        while True:
+            pks += [o.pk for o in page]
+            if not page.has_next():
+                break
+            page = p.page(page.next_cursor())
+        self.assertEqual(pks, self.expected)
+
+        pks, page = [], p.page(page.last_cursor())
+        self.assertFalse(page.has_next())
+        while True:
+            pks = [o.pk for o in page] + pks
+            if not page.has_previous():
+                break
+            page = p.page(page.previous_cursor())
+        self.assertEqual(pks, self.expected)
+
+        self.assertRaises(ValueError, p.page, 'not-a-cursor')
+
+    def test_cached_count(self):
+        """
+        Verify the count is only computed once per cache generation.
+        """
+        products = Product.objects.filter(title='Gin')
+        with self.assertNumQueries(1):
+            self.assertEqual(cached_count(products), 2)
+            self.assertEqual(cached_count(products), 2)
+
+        Product.objects.filter(title='Rum').update(title='Gin')
+        self.assertEqual(cached_count(products), 2)
+
+        bump_generation()
+        self.assertEqual(cached_count(products), 4)
+
+    def test_product_list_view(self):
+        """
+        Verify numbered pages redirect to the equivalent cursor.
+        """
+        response = self.client.get('/products/2/?pp=3')
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.get(response['Location'])
+        self.assertEqual([p.pk for p in response.context['products_page']],
+                self.expected[3:6])
+
+        self.assertEqual(self.client.get('/products/9/').status_code, 404)
+
+    def test_api(self):
+        """
+        Verify the API pages products by cursor.
+        """
+        url = '/api/v1/product/?format=json&limit=4'
+
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual(data['meta']['total_count'], 7)
+        self.assertEqual(data['meta']['previous'], None)
+        pks = [int(o['id']) for o in data['objects']]
+
+        data = json.loads(self.client.get(data['meta']['next']).content)
+        self.assertEqual(data['meta']['next'], None)
+        pks += [int(o['id']) for o in data['objects']]
+        self.assertEqual(pks, self.expected)
+
+        # Offsets still work
+        data = json.loads(self.client.get(url + '&offset=4').content)
+        self.assertEqual(len(data['objects']), 3)
+
+class TestApi(TestCase):
+    def setUp(self):
+        for i in range(3):
+            product = Product.objects.create(title='Gin %s' % i,
+                    code='%sB' % (1000 + i), slug='%sb' % (1000 + i))
+            for month in (1, 2):
+                ProductPrice.objects.create(product=product, amount='9.95',
+                        effective_date=datetime.date(2012, month, 1))
+
+        bump_generation()
+        clear_last_updated()
+
+    def test_embed_prices(self):
+        """
+        Verify product responses can embed their price history with
+        a single query.
+        """
+        url = '/api/v1/product/?format=json&prices=1'
+
+        # The import date, the count, the page and the prices
+        with self.assertNumQueries(4):
+            data = json.loads(self.client.get(url).content)
+
+        for obj in data['objects']:
+            self.assertEqual([p['effective_date'] for p in obj['prices']],
+                    ['2012-02-01', '2012-01-01'])
+
+        url = '/api/v1/product/%s/?format=json&prices=1' % obj['id']
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual(len(data['prices']), 2)
+
+        data = json.loads(self.client.get('/api/v1/product/?format=json').content)
+        self.assertFalse('prices' in data['objects'][0])
+
+    def test_price_list_queries(self):
+        """
+        Verify listing prices does not load each price's product.
+        """
+        url = '/api/v1/price/?format=json'
+
+        # The import date, the count and the page
+        with self.assertNumQueries(3):
+            data = json.loads(self.client.get(url).content)
+        self.assertEqual(len(data['objects']), 6)
+        self.assertTrue(data['objects'][0]['product'].startswith(
+            '/api/v1/product/'))
+
+    def test_price_history(self):
+        """
+        Verify the price history of several products is returned as
+        arrays, with a summary of each year.
+        """
+        products = list(Product.objects.order_by('code'))
+        ProductPrice.objects.create(product=products[0], amount='11.95',
+                effective_date=datetime.date(2013, 1, 1))
+
+        url = '/api/v1/product/history/?format=json&aggregate=year&ids=%s' % \
+                ','.join(str(p.pk) for p in reversed(products))
+
+        # The import date, the products and their prices
+        with self.assertNumQueries(3):
+            data = json.loads(self.client.get(url).content)
+
+        self.assertEqual([obj['id'] for obj in data['objects']],
+                [p.pk for p in reversed(products)])
+
+        history = data['objects'][-1]
+        self.assertEqual(history['code'], products[0].code)
+        self.assertEqual(history['dates'],
+                ['2012-01-01', '2012-02-01', '2013-01-01'])
+        self.assertEqual(history['amounts'], [9.95, 9.95, 11.95])
+        self.assertEqual(history['change'], 20.1)
+        self.assertEqual(history['years'], {
+            'years': [2012, 2013],
+            'min': [9.95, 11.95],
+            'max': [9.95, 11.95],
+            'avg': [9.95, 11.95],
+            'change': [0.0, 0.0],
+        })
+
+        # A single product, over a range of dates
+        url = '/api/v1/product/%s/history/?format=json&start=2012-02&end=2012-12' % \
+                products[0].pk
+        data = json.loads(self.client.get(url).content)
+        self.assertEqual(data['dates'], ['2012-02-01'])
+        self.assertFalse('years' in data)
+
+        for url in ('/api/v1/product/history/?format=json',
+                '/api/v1/product/history/?format=json&ids=foo',
+                '/api/v1/product/history/?format=json&ids=1&start=foo',
+                '/api/v1/product/history/?format=json&ids=1&aggregate=day'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+        response = self.client.get('/api/v1/product/0/history/?format=json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_cached_responses(self):
+        """
+        Verify serialized responses are cached until the next import.
+        """
+        url = '/api/v1/product/?format=json'
+        response = self.client.get(url)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(url)
+        self.assertEqual(cached.content, response.content)
+
+        Product.objects.update(title='Rum')
+        bump_generation()
+        self.assertTrue('Rum' in self.client.get(url).content)
+
+class TestExport(TestCase):
+    def setUp(self):
+        today = datetime.date.today().replace(day=1)
+
+        for code, title, amounts in (('1000B', u'Gin \xc9', ('9.95', '8.95')),
+                ('1001B', 'Rum, Dark', ('19.95', None))):
+            product = Product.objects.create(title=title, code=code,
+                    slug=code.lower(), proof='80')
+            for months, amount in zip((-1, 0), amounts):
+                if amount:
+                    ProductPrice.objects.create(product=product, amount=amount,
+                            effective_date=add_months(today, months))
+
+        Product.objects.update_prices()
+        bump_generation()
+
+    def test_export_csv(self):
+        """
+        Verify the catalog is exported as CSV with the latest prices.
+        """
+        response = self.client.get('/export/products.csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+
+        rows = list(csv.DictReader(response.content.splitlines()))
+        self.assertEqual([r['code'] for r in rows], ['1000B', '1001B'])
+        self.assertEqual(rows[0]['title'].decode('utf-8'), u'Gin \xc9')
+        self.assertEqual(rows[0]['previous_price'], '9.95')
+        self.assertEqual(rows[0]['current_price'], '8.95')
+        self.assertEqual(rows[1]['title'], 'Rum, Dark')
+        self.assertEqual(rows[1]['current_price'], '')
+
+    def test_export_ndjson(self):
+        """
+        Verify the catalog is exported as a JSON object per line, and
+        that exports are only regenerated after an import.
+        """
+        response = self.client.get('/export/products.ndjson')
+        lines = response.content.splitlines()
+        self.assertEqual(len(lines), 2)
+
+        product = json.loads(lines[0])
+        self.assertEqual(product['code'], '1000B')
+        self.assertEqual(Decimal(str(product['current_price'])), Decimal('8.95'))
+        self.assertEqual(product['next_price'], None)
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/export/products.ndjson',
+                    HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.client.get('/export/products.xml').status_code,
+                404)
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        Product.objects.create(title='Gin', code='4177B', slug='4177b')
+        bump_generation()
+        instrumentation.stats.clear()
+
+    def test_server_timing(self):
+        """
+        Verify responses report their query count and timings.
+        """
+        response = self.client.get('/products/4177b/')
+        timing = response['Server-Timing']
+
+        m = re.match(r'db;dur=[\d.]+;desc="(\d+) queries", tpl;dur=([\d.]+), '
+                r'total;dur=[\d.]+$', timing)
+        self.assertTrue(m, timing)
+        self.assertTrue(int(m.group(1)) > 0)
+        self.assertTrue(float(m.group(2)) > 0)
+
+        # Queries are still counted by assertNumQueries
+        with self.assertNumQueries(0):
+            response = self.client.get('/products/4177b/')
+        self.assertTrue('desc="0 queries"' in response['Server-Timing'])
+
+    def test_stats_view(self):
+        """
+        Verify request metrics are aggregated per view and only shown
+        to internal clients.
+        """
+        for i in range(3):
+            self.client.get('/products/4177b/')
+
+        data = json.loads(self.client.get('/_stats/').content)
+        view = data['views']['olcc.views.product_view']
+        self.assertEqual(view['latency_ms']['count'], 3)
+        self.assertEqual(sum(view['queries']['buckets'].values()), 3)
+
+        response = self.client.get('/_stats/', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 404)
+
+        # Scripts may clear the metrics without a CSRF token
+        client = Client(enforce_csrf_checks=True)
+        response = client.post('/_stats/', {'clear': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['views'], {})
+
+        response = client.post('/_stats/', {'clear': '1'},
+                REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(OLCC_QUERY_BUDGET=0)
+    @patch.object(instrumentation.logger, 'warning')
+    def test_query_budget(self, mock_warning):
+        """
+        Verify the SQL of requests over the query budget is logged.
+        """
+        self.client.get('/products/4177b/')
+
+        self.assertTrue(mock_warning.called)
+        self.assertTrue('olcc_product' in mock_warning.call_args[0][-1])
@@ -2,11 +2,13 @@ from django.conf.urls.defaults import patterns, url, include
 from django.views.generic.simple import direct_to_template
 
 from tastypie.api import Api
-from olcc.api import ProductResource, ProductPriceResource, StoreResource
+from olcc.api import PriceMoverResource, ProductResource, \
+        ProductPriceResource, StoreResource
 
 v1_api = Api(api_name='v1')
 v1_api.register(ProductResource())
 v1_api.register(ProductPriceResource())
+v1_api.register(PriceMoverResource())
 v1_api.register(StoreResource())
 
 urlpatterns = patterns('olcc.views',
@@ -23,9 +25,17 @@ urlpatterns = patterns('olcc.views',
     url(r'^sale/$', 'product_list_view', kwargs={'sale': True,}, name='sale'),
 
     # Stores
+    url(r'^stores/near/$', 'store_near_view', name='stores_near'),
     url(r'^stores/(?P<county>[\w\s]+)/$', 'store_view'),
     url(r'^stores/$', 'store_view', name='stores'),
 
+    # Export
+    url(r'^export/products\.(?P<format>csv|ndjson)$', 'export_view',
+            name='export'),
+
+    # Request metrics
+    url(r'^_stats/$', 'stats_view', name='stats'),
+
     # REST API
     (r'^api/', include(v1_api.urls)),
 )
@@ -1,23 +1,38 @@
+import datetime
+import json
+import os
+
+from django.conf import settings
 from django.core.paginator import Paginator, InvalidPage
-from django.db.models import Q
-from django.http import Http404
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render_to_response, redirect
 from django.template import RequestContext
+from django.utils.cache import patch_cache_control
+from django.views.decorators.csrf import csrf_exempt
 
+from olcc.caching import cache_page, conditional
+from olcc.export import EXPORT_FORMATS, EXPORT_MAX_AGE, export_products
 from olcc.forms import CountyForm
-from olcc.models import Product, ProductPrice, Store
+from olcc.history import parse_date
+from olcc.instrumentation import stats
+from olcc.models import MOVER_SORTS, PriceMover, Product, ProductPrice, \
+        Store
+from olcc.pagination import KeysetPaginator
+from olcc.search import search
+from olcc.spatial import nearest_stores, parse_location
 
+@conditional
 def home_view(request):
     """
     The site landing page.
     """
     # Get a random set of on sale products to highlight
-    on_sale = Product.objects.on_sale().order_by('?')[:5]
+    on_sale = Product.objects.sample(5, on_sale=True)
 
     # Get a random set of products to highlight, excluding
     # any on sale items we are already showing.
-    products = Product.objects.all().exclude(
-            pk__in=[p.pk for p in on_sale]).order_by('?')[:5]
+    products = Product.objects.sample(5, exclude=[p.pk for p in on_sale])
 
     context = {
         'on_sale': on_sale,
@@ -26,35 +41,74 @@ def home_view(request):
     return render_to_response('olcc/home.html',
             context, context_instance=RequestContext(request))
 
-def product_list_view(request, page=1, sale=False):
+@conditional
+@cache_page
+def product_list_view(request, page=None, sale=False):
     """
     Display a paginated list of products.
+
+    Search results are paginated by page number. Otherwise the products
+    are paginated by title with cursor tokens, so that deep pages are
+    no slower to load than the first.
+
+    Products on sale may instead be listed by their change in price
+    with the `sort` parameter, see `mover_list`.
     """
     per_page = int(request.GET.get('pp', 25))
 
+    sort = request.GET.get('sort')
+    if sale and sort and not request.GET.get('q'):
+        return mover_list(request, sort, page, per_page)
+
     if sale:
         title = 'On Sale'
+        view_name = 'sale'
         products = Product.objects.on_sale()
     else:
         title = 'Products'
+        view_name = 'products'
         products = Product.objects.all()
 
     # Filter the product list
     query = request.GET.get('q')
 
     if query:
-        products = products.filter(
-                Q(title__icontains=query) | Q(code__iexact=query))
+        # Search the product list, ordering the product ids by relevance
+        products = search(query, products)
 
-    # Order the product list
-    products = products.order_by('title')
+        p = Paginator(products, per_page)
+        try:
+            products_page = p.page(page or 1)
+        except InvalidPage:
+            raise Http404
+
+        # Load the products for this page of search results
+        objects = Product.objects.in_bulk(products_page.object_list)
+        products_page.object_list = [objects[pk] for pk in
+                products_page.object_list if pk in objects]
+    else:
+        p = KeysetPaginator(products, per_page)
+
+        if page and int(page) > 1:
+            # Send numbered pages to the equivalent cursor. The redirect is
+            # temporary, since the cursor changes with each import.
+            offset = (int(page) - 1) * per_page - 1
+            try:
+                row = products.order_by('title', 'pk')[offset]
+            except IndexError:
+                raise Http404
+
+            url = '%s?cursor=%s' % (reverse(view_name),
+                    p.cursor('after', row))
+            if 'pp' in request.GET:
+                url += '&pp=%s' % per_page
+            return redirect(url)
+
+        try:
+            products_page = p.page(request.GET.get('cursor'))
+        except ValueError:
+            raise Http404
 
-    p = Paginator(products, per_page)
-    try:
-        products_page = p.page(page)
-    except InvalidPage:
-        raise Http404
-    
     context = {
         'title': title,
         'products_page': products_page, 
@@ -65,6 +119,46 @@ def product_list_view(request, page=1, sale=False):
     return render_to_response('olcc/product_list.html',
             context, context_instance=RequestContext(request))
 
+def mover_list(request, sort, page, per_page):
+    """
+    Display a paginated list of the biggest drops or increases in price
+    for the month given by the `month` parameter, or this month.
+    """
+    if sort not in MOVER_SORTS:
+        raise Http404
+
+    try:
+        month = parse_date(request.GET['month']) if 'month' in request.GET \
+                else datetime.date.today()
+    except ValueError:
+        raise Http404
+
+    movers = PriceMover.objects.top(month, sort).select_related('product')
+
+    p = Paginator(movers, per_page)
+    try:
+        movers_page = p.page(page or 1)
+    except InvalidPage:
+        raise Http404
+
+    context = {
+        'title': 'On Sale',
+        'movers_page': movers_page,
+        'month': month.replace(day=1),
+        'sort': sort,
+        'sorts': (
+            ('drop', 'Biggest drops'),
+            ('percent_drop', 'Biggest % drops'),
+            ('increase', 'Biggest increases'),
+            ('percent_increase', 'Biggest % increases'),
+        ),
+    }
+
+    return render_to_response('olcc/mover_list.html',
+            context, context_instance=RequestContext(request))
+
+@conditional
+@cache_page
 def product_view(request, slug):
     """
     Display product details.
@@ -76,12 +170,15 @@ def product_view(request, slug):
 
     context = {
         'product': product,
-        'prices': product.prices.all()[:12]
+        # Evaluate the prices once, rather than counting them in the template
+        'prices': list(product.prices.all()[:12]),
     }
 
     return render_to_response('olcc/product.html',
             context, context_instance=RequestContext(request))
 
+@conditional
+@cache_page
 def store_view(request, county=None):
     """
     Display a form for filtering a list of stores by county.
@@ -115,3 +212,63 @@ def store_view(request, county=None):
 
     return render_to_response('olcc/store_list.html',
             context, context_instance=RequestContext(request))
+
+@conditional
+def export_view(request, format):
+    """
+    Stream the whole product catalog with the previous, current and
+    next prices of each product as CSV or newline delimited JSON.
+    """
+    if format not in EXPORT_FORMATS:
+        raise Http404
+
+    response = HttpResponse(export_products(format),
+            content_type=EXPORT_FORMATS[format])
+    response['Content-Disposition'] = \
+            'attachment; filename="olcc-products.%s"' % format
+
+    # Exports only change with each import
+    patch_cache_control(response, public=True, max_age=EXPORT_MAX_AGE)
+
+    return response
+
+@conditional
+def store_near_view(request):
+    """
+    Display the stores nearest the given latitude and longitude.
+    """
+    try:
+        lat, lng, k = parse_location(request.GET)
+    except ValueError, e:
+        return HttpResponseBadRequest(str(e), content_type='text/plain')
+
+    context = {
+        'form': CountyForm(),
+        'near': (lat, lng),
+        'stores': nearest_stores(lat, lng, k),
+    }
+
+    return render_to_response('olcc/store_list.html',
+            context, context_instance=RequestContext(request))
+
+@csrf_exempt
+def stats_view(request):
+    """
+    Display the request metrics recorded by this process as JSON. Only
+    visible to clients listed in INTERNAL_IPS, which may also POST
+    `clear=1` to reset the metrics, without a CSRF token since they are
+    usually scripts.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        raise Http404
+
+    if request.method == 'POST' and request.POST.get('clear'):
+        stats.clear()
+
+    data = {
+        'pid': os.getpid(),
+        'views': stats.as_dict(),
+    }
+
+    return HttpResponse(json.dumps(data, indent=2, sort_keys=True),
+            content_type='application/json')
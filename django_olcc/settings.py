@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 # Paths suitable for both development and deployment
 # to Heroku Cedar.
@@ -95,6 +96,30 @@ STATICFILES_FINDERS = (
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = 'r9z6b+z9s=_poqa)b62a3jop0ovp#1qgd%xdk%1uz4x71g!m^6'
 
+# The cache must be shared by the web workers and the management commands,
+# so that the cache generation bumped at the end of each import expires
+# every cached page. A file based cache is shared by every process on the
+# same host, unlike the local memory cache which each process keeps to
+# itself.
+#
+# Every product page, product row, list page and API response is cached
+# until the next import, so the cache must hold several entries for each
+# product, see olcc.caching.check_cache_size. The default limit of 300
+# entries would cull pages long before the next import. The file based
+# cache counts its files before every write, so memcached should be used
+# in production, with enough memory for a few hundred megabytes of pages.
+OLCC_CACHE_MAX_ENTRIES = 100000
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'django_olcc_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': OLCC_CACHE_MAX_ENTRIES,
+        },
+    }
+}
+
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
@@ -112,9 +137,11 @@ TEMPLATE_CONTEXT_PROCESSORS = (
     'django.contrib.messages.context_processors.messages',
     'django.core.context_processors.request',
     'olcc.context_processors.last_updated',
+    'olcc.context_processors.cache_generation',
 )
 
 MIDDLEWARE_CLASSES = (
+    'olcc.instrumentation.InstrumentationMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -162,7 +189,11 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler'
+        },
     },
     'loggers': {
         'django.request': {
@@ -170,6 +201,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'olcc': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': True,
+        },
     }
 }
 
@@ -181,6 +217,16 @@ SENTRY_DSN = \
 OLCC_PRICE_LIST_URL = \
         "http://www.olcc.state.or.us/pdfs/NumericPriceListNextMonth.csv"
 
+# How long to cache pages and data derived from the latest import
+OLCC_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+# Log the SQL of any request running more queries than this
+OLCC_QUERY_BUDGET = 25
+
+# The geocoder used to locate stores and its request budget
+OLCC_GEOCODER = 'olcc.geocoding.GoogleGeocoder'
+OLCC_GEOCODER_QPS = 2.5
+
 # Import local settings
 try:
     from settings_local import *
@@ -188,3 +234,25 @@ except ImportError:
     # Heroku database config
     import dj_database_url
     DATABASES = {'default': dj_database_url.config(default='postgres://localhost')}
+
+    # Heroku memcache config
+    if 'MEMCACHE_SERVERS' in os.environ:
+        CACHES = {
+            'default': {
+                'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+            }
+        }
+    else:
+        # Dynos do not share a filesystem, so fall back to a cache table
+        # in the shared database. Create it with:
+        #
+        #     $ python manage.py createcachetable olcc_cache
+        CACHES = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                'LOCATION': 'olcc_cache',
+                'OPTIONS': {
+                    'MAX_ENTRIES': OLCC_CACHE_MAX_ENTRIES,
+                },
+            }
+        }